@@ -1,5 +1,9 @@
 from aiogram import Bot, Dispatcher
-from config import TOKEN
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from config import TOKEN, TELEGRAM_API_URL
+from database.fsm_storage import create_fsm_storage
 
-bot = Bot(token=TOKEN)
-dp = Dispatcher()
\ No newline at end of file
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=TOKEN, session=session)
+dp = Dispatcher(storage=create_fsm_storage())
\ No newline at end of file
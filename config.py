@@ -4,3 +4,31 @@ from dotenv import load_dotenv
 load_dotenv()
 
 TOKEN = os.getenv("BOT_TOKEN")
+
+# Хранилище состояний FSM: memory | postgres | redis (для redis нужен пакет redis, он не входит в requirements.txt)
+FSM_STORAGE = os.getenv("FSM_STORAGE", "postgres")
+FSM_TTL = int(os.getenv("FSM_TTL", 7 * 24 * 3600))
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", 0.2))
+FSM_BATCH_SIZE = int(os.getenv("FSM_BATCH_SIZE", 200))
+FSM_CLEANUP_INTERVAL = float(os.getenv("FSM_CLEANUP_INTERVAL", 3600))
+FSM_COMPRESS_THRESHOLD = int(os.getenv("FSM_COMPRESS_THRESHOLD", 1024))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+# Режим работы: polling | webhook | supervisor
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", 40))
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", 8080))
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", 30))
+
+# Адрес Bot API (например, локальный сервер или заглушка для тестов)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL") or None
+
+# Режим supervisor: число воркеров и контроль их состояния
+WORKERS = int(os.getenv("WORKERS", os.cpu_count() or 2))
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", 1000))
+HEALTH_CHECK_INTERVAL = float(os.getenv("HEALTH_CHECK_INTERVAL", 5))
+HEARTBEAT_TIMEOUT = float(os.getenv("HEARTBEAT_TIMEOUT", 30))
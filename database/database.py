@@ -1,6 +1,8 @@
 import asyncpg
 import os
 import logging
+from datetime import datetime, timedelta
+from decimal import Decimal
 from dotenv import load_dotenv
 
 # Загрузка переменных окружения
@@ -17,68 +19,259 @@ DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_HOST = os.getenv("DB_HOST")
 DB_PORT = os.getenv("DB_PORT")
 
-async def connect_db():
-    """Подключение к базе данных"""
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 2))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 10))
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", 10))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", 30))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 100))
+DB_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_MAX_INACTIVE_LIFETIME", 300))
+
+pool = None
+
+# Версия данных о принтерах: увеличивается при каждой записи в printers
+_printers_version = 0
+
+def printers_version():
+    return _printers_version
+
+def _printers_changed():
+    global _printers_version
+    _printers_version += 1
+
+async def init_pool():
+    """Создание общего пула соединений с БД"""
+    global pool
+    if pool is not None:
+        return pool
     try:
-        return await asyncpg.connect(
+        pool = await asyncpg.create_pool(
             database=DB_NAME,
             user=DB_USER,
             password=DB_PASSWORD,
             host=DB_HOST,
-            port=DB_PORT
+            port=DB_PORT,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            command_timeout=DB_COMMAND_TIMEOUT,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+            max_inactive_connection_lifetime=DB_MAX_INACTIVE_LIFETIME
         )
+        return pool
     except Exception as e:
         logger.error(f"Ошибка подключения к БД: {e}")
         raise
 
+async def close_pool():
+    """Закрытие пула соединений"""
+    global pool
+    if pool is None:
+        return
+    await pool.close()
+    pool = None
+
+def acquire():
+    """Получение соединения из пула (используется как async with)"""
+    if pool is None:
+        raise RuntimeError("Пул соединений с БД не инициализирован")
+    return pool.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+
 async def create_tables():
     """Создание таблиц printers и reviews"""
-    conn = await connect_db()
-    try:
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS printers (
-                id SERIAL PRIMARY KEY,
-                telegram_id BIGINT UNIQUE NOT NULL,
-                chat_id BIGINT NOT NULL,
-                full_name TEXT NOT NULL,
-                username TEXT,
-                registered_at TIMESTAMP DEFAULT NOW(),
-                room_number TEXT NOT NULL,
-                price_per_page NUMERIC(5,3) CHECK (price_per_page >= 0) NOT NULL,
-                price_per_page_color NUMERIC(5,3) CHECK (price_per_page_color >= 0) NOT NULL DEFAULT 0.0,
-                total_earnings NUMERIC(10,3) DEFAULT 0 CHECK (total_earnings >= 0),
-                is_active BOOLEAN DEFAULT TRUE,
-                description TEXT DEFAULT '',
-                card_number TEXT DEFAULT '',
-                printer_type TEXT DEFAULT ''
-            );
-        """)
-
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS reviews (
-                id SERIAL PRIMARY KEY,
-                printer_id BIGINT NOT NULL REFERENCES printers(telegram_id) ON DELETE CASCADE,
-                user_id BIGINT NOT NULL,
-                rating INT CHECK (rating BETWEEN 1 AND 5) NOT NULL,
-                comment TEXT,
-                created_at TIMESTAMP DEFAULT NOW()
-            );
-        """)
-
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS printer_stats (
-                id SERIAL PRIMARY KEY,
-                printer_id BIGINT NOT NULL REFERENCES printers(telegram_id) ON DELETE CASCADE,
-                total_pages_printed INTEGER DEFAULT 0 CHECK (total_pages_printed >= 0),
-                total_earnings NUMERIC(10,3) DEFAULT 0 CHECK (total_earnings >= 0),
-                total_orders_completed INTEGER DEFAULT 0 CHECK (total_orders_completed >= 0),
-                first_order_date TIMESTAMP DEFAULT NOW()
-            );
-        """)
-    except Exception as e:
-        logger.error(f"Ошибка при создании таблиц: {e}")
-    finally:
-        await conn.close()
+    async with acquire() as conn:
+        try:
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS printers (
+                    id SERIAL PRIMARY KEY,
+                    telegram_id BIGINT UNIQUE NOT NULL,
+                    chat_id BIGINT NOT NULL,
+                    full_name TEXT NOT NULL,
+                    username TEXT,
+                    registered_at TIMESTAMP DEFAULT NOW(),
+                    room_number TEXT NOT NULL,
+                    price_per_page NUMERIC(5,3) CHECK (price_per_page >= 0) NOT NULL,
+                    price_per_page_color NUMERIC(5,3) CHECK (price_per_page_color >= 0) NOT NULL DEFAULT 0.0,
+                    total_earnings NUMERIC(10,3) DEFAULT 0 CHECK (total_earnings >= 0),
+                    is_active BOOLEAN DEFAULT TRUE,
+                    description TEXT DEFAULT '',
+                    card_number TEXT DEFAULT '',
+                    printer_type TEXT DEFAULT ''
+                );
+            """)
+
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS reviews (
+                    id SERIAL PRIMARY KEY,
+                    printer_id BIGINT NOT NULL REFERENCES printers(telegram_id) ON DELETE CASCADE,
+                    user_id BIGINT NOT NULL,
+                    rating INT CHECK (rating BETWEEN 1 AND 5) NOT NULL,
+                    comment TEXT,
+                    created_at TIMESTAMP DEFAULT NOW()
+                );
+            """)
+
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS printer_stats (
+                    id SERIAL PRIMARY KEY,
+                    printer_id BIGINT NOT NULL REFERENCES printers(telegram_id) ON DELETE CASCADE,
+                    total_pages_printed INTEGER DEFAULT 0 CHECK (total_pages_printed >= 0),
+                    total_earnings NUMERIC(10,3) DEFAULT 0 CHECK (total_earnings >= 0),
+                    total_orders_completed INTEGER DEFAULT 0 CHECK (total_orders_completed >= 0),
+                    first_order_date TIMESTAMP DEFAULT NOW()
+                );
+            """)
+
+            # Одна строка статистики на принтер: объединяем дубликаты и добавляем уникальный индекс
+            async with conn.transaction():
+                await conn.execute("""
+                    UPDATE printer_stats s
+                    SET total_pages_printed = m.total_pages_printed,
+                        total_earnings = m.total_earnings,
+                        total_orders_completed = m.total_orders_completed,
+                        first_order_date = m.first_order_date
+                    FROM (
+                        SELECT printer_id, MIN(id) AS keep_id,
+                               SUM(total_pages_printed) AS total_pages_printed,
+                               SUM(total_earnings) AS total_earnings,
+                               SUM(total_orders_completed) AS total_orders_completed,
+                               MIN(first_order_date) AS first_order_date
+                        FROM printer_stats GROUP BY printer_id HAVING COUNT(*) > 1
+                    ) m
+                    WHERE s.id = m.keep_id;
+                """)
+                await conn.execute("""
+                    DELETE FROM printer_stats a USING printer_stats b
+                    WHERE a.printer_id = b.printer_id AND a.id > b.id;
+                """)
+                await conn.execute("""
+                    CREATE UNIQUE INDEX IF NOT EXISTS printer_stats_printer_id_key ON printer_stats (printer_id);
+                """)
+
+            # Структурированные возможности принтера вместо поиска по строке printer_type
+            await conn.execute("""
+                ALTER TABLE printers
+                    ADD COLUMN IF NOT EXISTS technology TEXT CHECK (technology IN ('laser', 'ink')),
+                    ADD COLUMN IF NOT EXISTS has_color BOOLEAN NOT NULL DEFAULT FALSE,
+                    ADD COLUMN IF NOT EXISTS has_scan BOOLEAN NOT NULL DEFAULT FALSE;
+            """)
+
+            # Строки типа берутся из фиксированного набора кнопок, поэтому сравниваем с учетом регистра:
+            # ILIKE при локали C/POSIX не сворачивает регистр кириллицы
+            await conn.execute("""
+                UPDATE printers
+                SET technology = CASE
+                        WHEN printer_type LIKE 'Лазерный%' THEN 'laser'
+                        WHEN printer_type LIKE 'Струйный%' THEN 'ink'
+                    END,
+                    has_color = printer_type LIKE '%цвет%',
+                    has_scan = printer_type LIKE '%скан%'
+                WHERE technology IS NULL AND printer_type <> '';
+            """)
+
+            await conn.execute("""
+                CREATE INDEX IF NOT EXISTS printers_capabilities_idx
+                ON printers (technology, has_color, has_scan) WHERE is_active;
+            """)
+
+            # Средний рейтинг хранится как сумма и количество оценок, обновляемые вместе с отзывом
+            await conn.execute("""
+                ALTER TABLE printers
+                    ADD COLUMN IF NOT EXISTS rating_sum INTEGER NOT NULL DEFAULT 0 CHECK (rating_sum >= 0),
+                    ADD COLUMN IF NOT EXISTS rating_count INTEGER NOT NULL DEFAULT 0 CHECK (rating_count >= 0);
+            """)
+
+            await conn.execute("""
+                UPDATE printers p
+                SET rating_sum = r.rating_sum, rating_count = r.rating_count
+                FROM (
+                    SELECT printer_id, SUM(rating) AS rating_sum, COUNT(*) AS rating_count
+                    FROM reviews GROUP BY printer_id
+                ) r
+                WHERE r.printer_id = p.telegram_id AND p.rating_count = 0;
+            """)
+
+            # Индекс под keyset-пагинацию отзывов; он же покрывает поиск по printer_id
+            await conn.execute("UPDATE reviews SET created_at = NOW() WHERE created_at IS NULL;")
+            await conn.execute("ALTER TABLE reviews ALTER COLUMN created_at SET NOT NULL;")
+            await conn.execute("""
+                CREATE INDEX IF NOT EXISTS reviews_printer_created_idx
+                ON reviews (printer_id, created_at DESC, id DESC);
+            """)
+            await conn.execute("DROP INDEX IF EXISTS reviews_printer_id_idx;")
+
+            # Индексы для постраничного вывода исполнителей
+            await conn.execute("CREATE INDEX IF NOT EXISTS printers_price_idx ON printers (price_per_page, id) WHERE is_active;")
+            await conn.execute("CREATE INDEX IF NOT EXISTS printers_room_idx ON printers (room_number, id) WHERE is_active;")
+            await conn.execute("""
+                CREATE INDEX IF NOT EXISTS printers_rating_idx
+                ON printers ((COALESCE(rating_sum::numeric / NULLIF(rating_count, 0), 0)), id) WHERE is_active;
+            """)
+
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS fsm_storage (
+                    key TEXT PRIMARY KEY,
+                    state TEXT,
+                    data BYTEA,
+                    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+                );
+            """)
+
+            await conn.execute("CREATE INDEX IF NOT EXISTS fsm_storage_updated_at_idx ON fsm_storage (updated_at);")
+
+            # Заказы: created -> sent -> completed / rejected
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS orders (
+                    id BIGSERIAL PRIMARY KEY,
+                    user_id BIGINT NOT NULL,
+                    printer_id BIGINT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'created'
+                        CHECK (status IN ('created', 'sent', 'completed', 'rejected')),
+                    total_pages INTEGER NOT NULL DEFAULT 0 CHECK (total_pages >= 0),
+                    total_price NUMERIC(10,3) NOT NULL DEFAULT 0 CHECK (total_price >= 0),
+                    requirements TEXT,
+                    payment_info TEXT,
+                    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+                );
+            """)
+
+            await conn.execute("CREATE INDEX IF NOT EXISTS orders_printer_status_idx ON orders (printer_id, status);")
+            await conn.execute("CREATE INDEX IF NOT EXISTS orders_user_idx ON orders (user_id, created_at DESC);")
+
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS order_files (
+                    id BIGSERIAL PRIMARY KEY,
+                    order_id BIGINT NOT NULL REFERENCES orders(id) ON DELETE CASCADE,
+                    file_id TEXT NOT NULL,
+                    file_name TEXT,
+                    pages INTEGER NOT NULL CHECK (pages >= 0),
+                    print_type TEXT,
+                    cost NUMERIC(10,3)
+                );
+            """)
+
+            await conn.execute("CREATE INDEX IF NOT EXISTS order_files_order_id_idx ON order_files (order_id);")
+
+            # Параметры печати: раскладка и двусторонняя печать на весь заказ, диапазон страниц на файл
+            await conn.execute("""
+                ALTER TABLE orders
+                ADD COLUMN IF NOT EXISTS pages_per_sheet SMALLINT NOT NULL DEFAULT 1 CHECK (pages_per_sheet IN (1, 2, 4)),
+                ADD COLUMN IF NOT EXISTS duplex BOOLEAN NOT NULL DEFAULT FALSE;
+            """)
+            await conn.execute("ALTER TABLE order_files ADD COLUMN IF NOT EXISTS page_range TEXT;")
+
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS document_cache (
+                    file_unique_id TEXT PRIMARY KEY,
+                    pages INTEGER NOT NULL CHECK (pages > 0),
+                    color_pages INTEGER[],
+                    file_size BIGINT,
+                    created_at TIMESTAMP DEFAULT NOW()
+                );
+            """)
+        except Exception as e:
+            logger.error(f"Ошибка при создании таблиц: {e}")
+            # Без схемы бот работать не может: запуск должен завершиться ошибкой
+            raise
 
 async def register_printer(
     telegram_id: int, chat_id: int, full_name: str, username: str,
@@ -87,240 +280,370 @@ async def register_printer(
     if price_per_page < 0:
         raise ValueError("Цена за страницу не может быть отрицательной")
 
-    conn = await connect_db()
-    try:
-        existing = await conn.fetchval("SELECT telegram_id FROM printers WHERE telegram_id = $1;", telegram_id)
-
-        if existing:
-            await conn.execute("""
-                UPDATE printers 
-                SET full_name = $2, username = $3, room_number = $4, 
-                    price_per_page = $5, price_per_page_color = $6, description = $7, card_number = $8
-                WHERE telegram_id = $1;
-            """, telegram_id, full_name, username, room_number, price_per_page, price_per_page_color, description, card_number)
-        else:
+    async with acquire() as conn:
+        try:
             await conn.execute("""
                 INSERT INTO printers (telegram_id, chat_id, full_name, username, room_number, price_per_page, price_per_page_color, is_active, description, card_number)
-                VALUES ($1, $2, $3, $4, $5, $6, $7, TRUE, $8, $9);
+                VALUES ($1, $2, $3, $4, $5, $6, $7, TRUE, $8, $9)
+                ON CONFLICT (telegram_id) DO UPDATE
+                SET full_name = EXCLUDED.full_name, username = EXCLUDED.username, room_number = EXCLUDED.room_number,
+                    price_per_page = EXCLUDED.price_per_page, price_per_page_color = EXCLUDED.price_per_page_color,
+                    description = EXCLUDED.description, card_number = EXCLUDED.card_number;
             """, telegram_id, chat_id, full_name, username, room_number, price_per_page, price_per_page_color, description, card_number)
-    except Exception as e:
-        logger.error(f"Ошибка при регистрации принтера: {e}")
-    finally:
-        await conn.close()
+        except Exception as e:
+            logger.error(f"Ошибка при регистрации принтера: {e}")
+    _printers_changed()
 
 
 async def update_total_earnings(telegram_id: int, amount: float):
     if amount < 0:
         raise ValueError("Сумма заработка не может быть отрицательной")
 
-    conn = await connect_db()
-    try:
-        await conn.execute("""
-            UPDATE printers
-            SET total_earnings = total_earnings + $1
-            WHERE telegram_id = $2;
-        """, amount, telegram_id)
-    except Exception as e:
-        logger.error(f"Ошибка при обновлении заработка: {e}")
-    finally:
-        await conn.close()
+    async with acquire() as conn:
+        try:
+            await conn.execute("""
+                UPDATE printers
+                SET total_earnings = total_earnings + $1
+                WHERE telegram_id = $2;
+            """, amount, telegram_id)
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении заработка: {e}")
+
+# Ключи сортировки списка исполнителей: выражение и направление
+PRINTER_SORTS = {
+    "price": ("p.price_per_page", "ASC"),
+    "room": ("p.room_number", "ASC"),
+    "rating": ("COALESCE(p.rating_sum::numeric / NULLIF(p.rating_count, 0), 0)", "DESC"),
+}
+
+async def get_all_printers(
+    sort: str = "price", after_id: int = None, before_id: int = None, limit: int = None,
+    technology: str = None, color: bool = False, scan: bool = False
+):
+    """
+    Страница активных исполнителей с keyset-пагинацией.
+
+    Курсор — id последней (after_id) или первой (before_id) записи предыдущей страницы,
+    значение ключа сортировки для него берется из БД, поэтому в callback_data хватает одного id.
+    Фильтры по возможностям принтера комбинируются через AND.
+    """
+    sort_expr, direction = PRINTER_SORTS.get(sort, PRINTER_SORTS["price"])
+    backwards = before_id is not None
+    if backwards:
+        direction = "DESC" if direction == "ASC" else "ASC"
+
+    conditions = ["p.is_active = TRUE"]
+    values = []
+
+    if technology:
+        values.append(technology)
+        conditions.append("p.technology = $" + str(len(values)))
+    if color:
+        conditions.append("p.has_color")
+    if scan:
+        conditions.append("p.has_scan")
+
+    cursor_id = before_id if backwards else after_id
+    if cursor_id is not None:
+        values.append(cursor_id)
+        operator = ">" if direction == "ASC" else "<"
+        conditions.append(
+            f"({sort_expr}, p.id) {operator} (SELECT {sort_expr}, p.id FROM printers p WHERE p.id = ${len(values)})"
+        )
 
-async def get_all_printers():
-    conn = await connect_db()
-    try:
-        return await conn.fetch("""
-            SELECT chat_id, full_name, room_number, price_per_page, price_per_page_color, printer_type 
-            FROM printers
-            WHERE is_active = TRUE;
-        """)
-    except Exception as e:
-        logger.error(f"Ошибка при получении списка принтеров: {e}")
-        return []
-    finally:
-        await conn.close()
+    query = (
+        "SELECT p.id, p.chat_id, p.full_name, p.room_number, p.price_per_page, p.price_per_page_color, p.printer_type "
+        "FROM printers p WHERE " + " AND ".join(conditions) +
+        f" ORDER BY {sort_expr} {direction}, p.id {direction}"
+    )
+    if limit:
+        values.append(limit)
+        query += " LIMIT $" + str(len(values))
+
+    async with acquire() as conn:
+        try:
+            rows = await conn.fetch(query + ";", *values)
+            return list(reversed(rows)) if backwards else rows
+        except Exception as e:
+            logger.error(f"Ошибка при получении списка принтеров: {e}")
+            return []
 
 async def get_printer_room(printer_id: int):
-    conn = await connect_db()
-    try:
-        return await conn.fetchval("SELECT room_number FROM printers WHERE chat_id = $1;", printer_id)
-    except Exception as e:
-        logger.error(f"Ошибка при получении номера комнаты: {e}")
-        return None
-    finally:
-        await conn.close()
+    async with acquire() as conn:
+        try:
+            return await conn.fetchval("SELECT room_number FROM printers WHERE chat_id = $1;", printer_id)
+        except Exception as e:
+            logger.error(f"Ошибка при получении номера комнаты: {e}")
+            return None
 
 async def toggle_printer_status(printer_id: int):
-    conn = await connect_db()
-    try:
-        current_status = await conn.fetchval("SELECT is_active FROM printers WHERE chat_id = $1;", printer_id)
-        new_status = not current_status
-        await conn.execute("UPDATE printers SET is_active = $1 WHERE chat_id = $2;", new_status, printer_id)
-        return new_status
-    except Exception as e:
-        logger.error(f"Ошибка при изменении статуса принтера: {e}")
-        return None
-    finally:
-        await conn.close()
+    async with acquire() as conn:
+        try:
+            current_status = await conn.fetchval("SELECT is_active FROM printers WHERE chat_id = $1;", printer_id)
+            new_status = not current_status
+            await conn.execute("UPDATE printers SET is_active = $1 WHERE chat_id = $2;", new_status, printer_id)
+            _printers_changed()
+            return new_status
+        except Exception as e:
+            logger.error(f"Ошибка при изменении статуса принтера: {e}")
+            return None
 
 async def get_printer_status(printer_id: int):
     """Получение статуса активности принтера"""
-    conn = await connect_db()
-    try:
-        return await conn.fetchval("SELECT is_active FROM printers WHERE chat_id = $1;", printer_id)
-    except Exception as e:
-        logger.error(f"Ошибка при получении статуса принтера: {e}")
-        return None
-    finally:
-        await conn.close()
+    async with acquire() as conn:
+        try:
+            return await conn.fetchval("SELECT is_active FROM printers WHERE chat_id = $1;", printer_id)
+        except Exception as e:
+            logger.error(f"Ошибка при получении статуса принтера: {e}")
+            return None
 
 async def get_printer_info(telegram_id: int):
     """Получение информации о принтере"""
-    conn = await connect_db()
-    try:
-        return await conn.fetchrow("""
-            SELECT chat_id, full_name, room_number, price_per_page, price_per_page_color, description, printer_type, card_number
-            FROM printers WHERE telegram_id = $1;
-        """, telegram_id)
-    except Exception as e:
-        logger.error(f"Ошибка при получении информации о принтере: {e}")
-        return None
-    finally:
-        await conn.close()
+    async with acquire() as conn:
+        try:
+            return await conn.fetchrow("""
+                SELECT chat_id, full_name, room_number, price_per_page, price_per_page_color, description, printer_type, card_number
+                FROM printers WHERE telegram_id = $1;
+            """, telegram_id)
+        except Exception as e:
+            logger.error(f"Ошибка при получении информации о принтере: {e}")
+            return None
 
 async def update_printer_info(telegram_id: int, room_number: str = None, price_per_page: float = None, price_per_page_color: float = None):
-    conn = await connect_db()
-    try:
-        fields = []
-        values = []
-
-        if room_number:
-            fields.append("room_number = $" + str(len(values) + 1))
-            values.append(room_number)
-
-        if price_per_page is not None:
-            fields.append("price_per_page = $" + str(len(values) + 1))
-            values.append(price_per_page)
-
-        if fields:
-            query = "UPDATE printers SET " + ", ".join(fields) + " WHERE telegram_id = $" + str(len(values) + 1)
-            values.append(telegram_id)
-            await conn.execute(query, *values)
-    except Exception as e:
-        logger.error(f"Ошибка при обновлении данных принтера: {e}")
-    finally:
-        await conn.close()
+    async with acquire() as conn:
+        try:
+            fields = []
+            values = []
+
+            if room_number:
+                fields.append("room_number = $" + str(len(values) + 1))
+                values.append(room_number)
+
+            if price_per_page is not None:
+                fields.append("price_per_page = $" + str(len(values) + 1))
+                values.append(price_per_page)
+
+            if fields:
+                query = "UPDATE printers SET " + ", ".join(fields) + " WHERE telegram_id = $" + str(len(values) + 1)
+                values.append(telegram_id)
+                await conn.execute(query, *values)
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении данных принтера: {e}")
+    _printers_changed()
 
 async def update_printer_description(telegram_id: int, description: str):
-    conn = await connect_db()
-    try:
-        await conn.execute("UPDATE printers SET description = $1 WHERE telegram_id = $2;", description, telegram_id)
-    except Exception as e:
-        logger.error(f"Ошибка при обновлении описания: {e}")
-    finally:
-        await conn.close()
+    async with acquire() as conn:
+        try:
+            await conn.execute("UPDATE printers SET description = $1 WHERE telegram_id = $2;", description, telegram_id)
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении описания: {e}")
+    _printers_changed()
 
 async def update_printer_price_per_page_color(telegram_id: int, price_per_page_color: float = None):
-    conn = await connect_db()
-    try:
-        await conn.execute("UPDATE printers SET price_per_page_color = $1 WHERE telegram_id = $2;", price_per_page_color, telegram_id)
-    except Exception as e:
-        logger.error(f"Ошибка при обновлении описания: {e}")
-    finally:
-        await conn.close()
+    async with acquire() as conn:
+        try:
+            await conn.execute("UPDATE printers SET price_per_page_color = $1 WHERE telegram_id = $2;", price_per_page_color, telegram_id)
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении описания: {e}")
+    _printers_changed()
+
+def parse_printer_type(printer_type: str):
+    """Возможности принтера по строке типа: (технология, цвет, скан); правила те же, что у миграции в create_tables"""
+    text = printer_type or ""
+    technology = "laser" if text.startswith("Лазерный") else "ink" if text.startswith("Струйный") else None
+    return technology, "цвет" in text, "скан" in text
 
 async def update_printer_type(telegram_id: int, printer_type: str):
-    conn = await connect_db()
-    try:
-        await conn.execute("UPDATE printers SET printer_type = $1 WHERE telegram_id = $2;", printer_type, telegram_id)
-    except Exception as e:
-        logger.error(f"Ошибка при обновлении типа принтера: {e}")
-    finally:
-        await conn.close()
+    technology, has_color, has_scan = parse_printer_type(printer_type)
+    async with acquire() as conn:
+        try:
+            await conn.execute("""
+                UPDATE printers
+                SET printer_type = $1, technology = $2, has_color = $3, has_scan = $4
+                WHERE telegram_id = $5;
+            """, printer_type, technology, has_color, has_scan, telegram_id)
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении типа принтера: {e}")
+    _printers_changed()
 
 async def add_review(printer_id: int, user_id: int, rating: int, comment: str):
-    conn = await connect_db()
-    try:
-        await conn.execute("""
-            INSERT INTO reviews (printer_id, user_id, rating, comment)
-            VALUES ($1, $2, $3, $4);
-        """, printer_id, user_id, rating, comment)
-    except Exception as e:
-        logger.error(f"Ошибка при добавлении отзыва: {e}")
-    finally:
-        await conn.close()
-
-async def get_average_rating(printer_id: int):
-    conn = await connect_db()
-    try:
-        result = await conn.fetchval("""
-            SELECT AVG(rating) FROM reviews WHERE printer_id = $1;
-        """, printer_id)
-        return round(result, 1) if result else "Нет отзывов"
-    except Exception as e:
-        logger.error(f"Ошибка при получении среднего рейтинга: {e}")
-        return "Нет отзывов"
-    finally:
-        await conn.close()
-
-async def get_reviews(printer_id: int, limit: int = 15):
-    conn = await connect_db()
-    try:
-        return await conn.fetch("""
-            SELECT user_id, rating, comment, created_at 
-            FROM reviews
-            WHERE printer_id = $1 
-            ORDER BY created_at DESC
-            LIMIT $2;
-        """, printer_id, limit)  # Передаем ограничение
-    except Exception as e:
-        logger.error(f"Ошибка при получении отзывов: {e}")
-        return []
-    finally:
-        await conn.close()
-
-
-async def update_printer_stats(printer_id: int, total_pages: int, total_price: float):
-    conn = await connect_db()
-    async with conn.transaction():
-        # Проверяем, есть ли запись для принтера
-        existing_record = await conn.fetchrow(
-            "SELECT * FROM printer_stats WHERE printer_id = $1", printer_id
-        )
-
-        if existing_record:
-            # Если запись уже есть, обновляем статистику
-            await conn.execute(
-                """
-                UPDATE printer_stats
-                SET total_pages_printed = total_pages_printed + $1,
-                    total_earnings = total_earnings + $2,
-                    total_orders_completed = total_orders_completed + 1
-                WHERE printer_id = $3
-                """,
-                total_pages, total_price, printer_id
-            )
-        else:
-            # Если записи нет, создаем новую
-            await conn.execute(
-                """
+    async with acquire() as conn:
+        try:
+            async with conn.transaction():
+                await conn.execute("""
+                    INSERT INTO reviews (printer_id, user_id, rating, comment)
+                    VALUES ($1, $2, $3, $4);
+                """, printer_id, user_id, rating, comment)
+                await conn.execute("""
+                    UPDATE printers
+                    SET rating_sum = rating_sum + $2, rating_count = rating_count + 1
+                    WHERE telegram_id = $1;
+                """, printer_id, rating)
+        except Exception as e:
+            logger.error(f"Ошибка при добавлении отзыва: {e}")
+    _printers_changed()
+
+def format_rating(rating_sum: int, rating_count: int):
+    """Средний рейтинг по сохраненным сумме и количеству оценок"""
+    return round(rating_sum / rating_count, 1) if rating_count else "Нет отзывов"
+
+_EPOCH = datetime(1970, 1, 1)
+
+def encode_review_cursor(created_at: datetime, review_id: int):
+    """Курсор отзыва для callback_data: микросекунды от эпохи и id"""
+    return f"{(created_at - _EPOCH) // timedelta(microseconds=1)}_{review_id}"
+
+def decode_review_cursor(created_at: str, review_id: str):
+    return _EPOCH + timedelta(microseconds=int(created_at)), int(review_id)
+
+async def get_reviews_page(
+    printer_id: int, after_created_at: datetime = None, after_id: int = None, limit: int = 3, backwards: bool = False
+):
+    """
+    Страница отзывов от новых к старым, начиная после курсора (created_at, id).
+    При backwards=True возвращаются отзывы перед курсором (в том же порядке).
+    """
+    values = [printer_id]
+    condition = ""
+    if after_created_at is not None and after_id is not None:
+        values += [after_created_at, after_id]
+        condition = "AND (created_at, id) " + (">" if backwards else "<") + " ($2, $3)"
+    values.append(limit)
+
+    async with acquire() as conn:
+        try:
+            rows = await conn.fetch(f"""
+                SELECT id, user_id, rating, comment, created_at
+                FROM reviews
+                WHERE printer_id = $1 {condition}
+                ORDER BY created_at {"ASC" if backwards else "DESC"}, id {"ASC" if backwards else "DESC"}
+                LIMIT ${len(values)};
+            """, *values)
+            return list(reversed(rows)) if backwards else rows
+        except Exception as e:
+            logger.error(f"Ошибка при получении отзывов: {e}")
+            return []
+
+
+async def get_document_info(file_unique_id: str):
+    """Получение сохраненных данных о документе по file_unique_id"""
+    async with acquire() as conn:
+        try:
+            return await conn.fetchrow("""
+                SELECT pages, color_pages, file_size
+                FROM document_cache WHERE file_unique_id = $1;
+            """, file_unique_id)
+        except Exception as e:
+            logger.error(f"Ошибка при получении данных документа: {e}")
+            return None
+
+async def save_document_info(file_unique_id: str, pages: int, color_pages: list = None, file_size: int = None):
+    """Сохранение данных о документе (количество страниц, цветные страницы, размер)"""
+    async with acquire() as conn:
+        try:
+            await conn.execute("""
+                INSERT INTO document_cache (file_unique_id, pages, color_pages, file_size)
+                VALUES ($1, $2, $3, $4)
+                ON CONFLICT (file_unique_id) DO UPDATE
+                SET pages = EXCLUDED.pages,
+                    color_pages = COALESCE(EXCLUDED.color_pages, document_cache.color_pages),
+                    file_size = COALESCE(EXCLUDED.file_size, document_cache.file_size);
+            """, file_unique_id, pages, color_pages, file_size)
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении данных документа: {e}")
+
+async def get_printer_profile(telegram_id: int):
+    """Профиль, статистика и рейтинг исполнителя одним запросом"""
+    async with acquire() as conn:
+        try:
+            return await conn.fetchrow("""
+                SELECT p.chat_id, p.full_name, p.room_number, p.price_per_page, p.price_per_page_color,
+                       p.description, p.printer_type, p.card_number, p.rating_sum, p.rating_count,
+                       s.total_pages_printed, s.total_earnings, s.total_orders_completed, s.first_order_date
+                FROM printers p
+                LEFT JOIN printer_stats s ON s.printer_id = p.telegram_id
+                WHERE p.telegram_id = $1;
+            """, telegram_id)
+        except Exception as e:
+            logger.error(f"Ошибка при получении профиля принтера: {e}")
+            return None
+
+async def create_order(
+    user_id: int, printer_id: int, total_pages: int, total_price: Decimal,
+    requirements: str, payment_info: str, documents: list, pages_per_sheet: int = 1, duplex: bool = False
+):
+    """Создание заказа со списком файлов, возвращает id заказа"""
+    async with acquire() as conn:
+        try:
+            async with conn.transaction():
+                order_id = await conn.fetchval("""
+                    INSERT INTO orders (
+                        user_id, printer_id, total_pages, total_price, requirements, payment_info, pages_per_sheet, duplex
+                    )
+                    VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+                    RETURNING id;
+                """, user_id, printer_id, total_pages, total_price, requirements, payment_info, pages_per_sheet, duplex)
+                await conn.executemany("""
+                    INSERT INTO order_files (order_id, file_id, file_name, pages, print_type, cost, page_range)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7);
+                """, [
+                    (
+                        order_id, doc["file_id"], doc["file_name"], doc["pages"], doc.get("print_type"),
+                        Decimal(str(doc["cost"])) if doc.get("cost") is not None else None, doc.get("page_range")
+                    )
+                    for doc in documents
+                ])
+                return order_id
+        except Exception as e:
+            logger.error(f"Ошибка при создании заказа: {e}")
+            return None
+
+async def mark_order_sent(order_id: int):
+    """Заказ отправлен исполнителю"""
+    async with acquire() as conn:
+        try:
+            await conn.execute("""
+                UPDATE orders SET status = 'sent', updated_at = NOW()
+                WHERE id = $1 AND status = 'created';
+            """, order_id)
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении статуса заказа: {e}")
+
+async def complete_order(order_id: int, printer_id: int):
+    """
+    Завершение заказа исполнителем и обновление его статистики в одной транзакции.
+    Возвращает заказ или None, если заказ не найден или уже обработан.
+    """
+    async with acquire() as conn:
+        async with conn.transaction():
+            order = await conn.fetchrow("""
+                UPDATE orders SET status = 'completed', updated_at = NOW()
+                WHERE id = $1 AND printer_id = $2 AND status IN ('created', 'sent')
+                RETURNING user_id, printer_id, total_pages, total_price;
+            """, order_id, printer_id)
+            if not order:
+                return None
+
+            # Одна атомарная операция вместо SELECT + UPDATE/INSERT; гонок при параллельных заказах нет
+            await conn.execute("""
                 INSERT INTO printer_stats (printer_id, total_pages_printed, total_earnings, total_orders_completed, first_order_date)
                 VALUES ($1, $2, $3, 1, NOW())
-                """,
-                printer_id, total_pages, total_price
-            )
-
-    await conn.close()
-
-async def get_printer_stats(printer_id: int):
-    """Получение статистики принтера"""
-    conn = await connect_db()
-    try:
-        return await conn.fetchrow("""
-            SELECT total_pages_printed, total_earnings, total_orders_completed, first_order_date
-            FROM printer_stats WHERE printer_id = $1;
-        """, printer_id)
-    except Exception as e:
-        logger.error(f"Ошибка при получении статистики принтера: {e}")
-        return None
-    finally:
-        await conn.close()
+                ON CONFLICT (printer_id) DO UPDATE
+                SET total_pages_printed = printer_stats.total_pages_printed + EXCLUDED.total_pages_printed,
+                    total_earnings = printer_stats.total_earnings + EXCLUDED.total_earnings,
+                    total_orders_completed = printer_stats.total_orders_completed + 1;
+            """, printer_id, order["total_pages"], order["total_price"])
+            return order
+
+async def reject_order_by_printer(order_id: int, printer_id: int):
+    """Отказ исполнителя от заказа. Возвращает заказ или None, если он уже обработан"""
+    async with acquire() as conn:
+        try:
+            return await conn.fetchrow("""
+                UPDATE orders SET status = 'rejected', updated_at = NOW()
+                WHERE id = $1 AND printer_id = $2 AND status IN ('created', 'sent')
+                RETURNING user_id, printer_id;
+            """, order_id, printer_id)
+        except Exception as e:
+            logger.error(f"Ошибка при отказе от заказа: {e}")
+            return None
@@ -0,0 +1,230 @@
+import asyncio
+import copy
+import json
+import logging
+import zlib
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from config import (
+    FSM_STORAGE, FSM_TTL, FSM_FLUSH_INTERVAL, FSM_BATCH_SIZE, FSM_CLEANUP_INTERVAL,
+    FSM_COMPRESS_THRESHOLD, REDIS_URL
+)
+from database.database import acquire
+
+logger = logging.getLogger(__name__)
+
+_RAW = b"j"
+_ZLIB = b"z"
+
+
+def _pack(data: Mapping[str, Any]) -> bytes:
+    """Компактная сериализация данных FSM (JSON, при большом размере — zlib)"""
+    raw = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
+    if len(raw) >= FSM_COMPRESS_THRESHOLD:
+        return _ZLIB + zlib.compress(raw)
+    return _RAW + raw
+
+
+def _unpack(blob: Optional[bytes]) -> Dict[str, Any]:
+    if not blob:
+        return {}
+    blob = bytes(blob)
+    if blob[:1] == _ZLIB:
+        return json.loads(zlib.decompress(blob[1:]))
+    return json.loads(blob[1:])
+
+
+def _build_key(key: StorageKey) -> str:
+    return ":".join(str(part) if part is not None else "" for part in (
+        key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny
+    ))
+
+
+class PostgresStorage(BaseStorage):
+    """
+    Хранилище FSM в таблице fsm_storage.
+
+    Записи копятся в памяти и сбрасываются в БД пачками раз в FSM_FLUSH_INTERVAL секунд
+    (или сразу, если FSM_FLUSH_INTERVAL = 0). Чтение сначала смотрит в несброшенные записи,
+    поэтому внутри процесса данные всегда актуальны. Сессии, не изменявшиеся дольше FSM_TTL
+    секунд, считаются брошенными и удаляются.
+    """
+
+    def __init__(
+        self, ttl: int = FSM_TTL, flush_interval: float = FSM_FLUSH_INTERVAL,
+        batch_size: int = FSM_BATCH_SIZE, cleanup_interval: float = FSM_CLEANUP_INTERVAL
+    ):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.cleanup_interval = cleanup_interval
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._flushing: Dict[str, Dict[str, Any]] = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_event = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def _ensure_task(self):
+        if self.flush_interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    def _lookup(self, key: str, field: str):
+        """Поиск значения среди еще не записанных в БД изменений"""
+        for records in (self._pending, self._flushing):
+            record = records.get(key)
+            if record is not None and field in record:
+                return True, record[field]
+        return False, None
+
+    async def _write(self, key: StorageKey, **fields):
+        record = self._pending.setdefault(_build_key(key), {})
+        record.update(fields)
+
+        if self.flush_interval <= 0:
+            await self.flush()
+            return
+
+        self._ensure_task()
+        if len(self._pending) >= self.batch_size:
+            self._flush_event.set()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._write(key, state=state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        found, state = self._lookup(_build_key(key), "state")
+        if found:
+            return state
+
+        async with acquire() as conn:
+            return await conn.fetchval("""
+                SELECT state FROM fsm_storage
+                WHERE key = $1 AND updated_at > NOW() - make_interval(secs => $2);
+            """, _build_key(key), self.ttl)
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        await self._write(key, data=copy.deepcopy(dict(data)))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        found, data = self._lookup(_build_key(key), "data")
+        if found:
+            return copy.deepcopy(data)
+
+        async with acquire() as conn:
+            blob = await conn.fetchval("""
+                SELECT data FROM fsm_storage
+                WHERE key = $1 AND updated_at > NOW() - make_interval(secs => $2);
+            """, _build_key(key), self.ttl)
+        return _unpack(blob)
+
+    async def flush(self):
+        """Пакетная запись накопленных изменений в БД"""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            self._flushing = pending
+
+            try:
+                full, state_only, data_only = [], [], []
+                for key, record in list(pending.items()):
+                    try:
+                        if "state" in record and "data" in record:
+                            full.append((key, record["state"], _pack(record["data"])))
+                        elif "state" in record:
+                            state_only.append((key, record["state"]))
+                        else:
+                            data_only.append((key, _pack(record["data"])))
+                    except (TypeError, ValueError) as e:
+                        # Повторная попытка не поможет: запись отбрасывается, остальные сохраняются
+                        logger.error(f"Данные FSM {key} не сериализуются в JSON, запись пропущена: {e}")
+                        del pending[key]
+
+                async with acquire() as conn:
+                    async with conn.transaction():
+                        if full:
+                            await conn.executemany("""
+                                INSERT INTO fsm_storage (key, state, data, updated_at)
+                                VALUES ($1, $2, $3, NOW())
+                                ON CONFLICT (key) DO UPDATE
+                                SET state = EXCLUDED.state, data = EXCLUDED.data, updated_at = NOW();
+                            """, full)
+                        if state_only:
+                            await conn.executemany("""
+                                INSERT INTO fsm_storage (key, state, updated_at)
+                                VALUES ($1, $2, NOW())
+                                ON CONFLICT (key) DO UPDATE
+                                SET state = EXCLUDED.state, updated_at = NOW();
+                            """, state_only)
+                        if data_only:
+                            await conn.executemany("""
+                                INSERT INTO fsm_storage (key, data, updated_at)
+                                VALUES ($1, $2, NOW())
+                                ON CONFLICT (key) DO UPDATE
+                                SET data = EXCLUDED.data, updated_at = NOW();
+                            """, data_only)
+            except Exception as e:
+                logger.error(f"Ошибка при сохранении состояний FSM: {e}")
+                # Возвращаем несохраненные записи, не затирая более свежие
+                for key, record in pending.items():
+                    self._pending[key] = {**record, **self._pending.get(key, {})}
+            finally:
+                self._flushing = {}
+
+    async def cleanup(self):
+        """Удаление брошенных сессий старше FSM_TTL"""
+        try:
+            async with acquire() as conn:
+                await conn.execute("""
+                    DELETE FROM fsm_storage WHERE updated_at < NOW() - make_interval(secs => $1);
+                """, self.ttl)
+        except Exception as e:
+            logger.error(f"Ошибка при очистке состояний FSM: {e}")
+
+    async def _flush_loop(self):
+        loop = asyncio.get_running_loop()
+        next_cleanup = loop.time() + self.cleanup_interval
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            try:
+                await self.flush()
+
+                if loop.time() >= next_cleanup:
+                    await self.cleanup()
+                    next_cleanup = loop.time() + self.cleanup_interval
+            except Exception as e:
+                # Цикл записи не должен останавливаться, иначе новые изменения перестанут сохраняться
+                logger.exception(f"Ошибка в цикле записи состояний FSM: {e}")
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+def create_fsm_storage() -> BaseStorage:
+    """Создание хранилища FSM согласно настройке FSM_STORAGE (memory | postgres | redis)"""
+    if FSM_STORAGE == "postgres":
+        return PostgresStorage()
+    if FSM_STORAGE == "redis":
+        # Подходит и любой Redis-совместимый сервер (KeyDB, Dragonfly и т.п.)
+        # Пакет redis не входит в requirements.txt: он нужен только для этого режима (pip install redis)
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage
+        except ImportError as e:
+            raise RuntimeError("Для FSM_STORAGE=redis установите пакет redis: pip install redis") from e
+        return RedisStorage.from_url(REDIS_URL, state_ttl=FSM_TTL, data_ttl=FSM_TTL)
+    return MemoryStorage()
@@ -3,10 +3,14 @@ from aiogram.filters import Command
 from aiogram import F, Router, Bot
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
+from aiogram.exceptions import TelegramBadRequest
 from database.database import (
-    register_printer, get_all_printers, toggle_printer_status,
-    get_printer_status, get_printer_info, add_review, get_average_rating, get_reviews
+    register_printer, toggle_printer_status,
+    get_printer_status, get_printer_profile, format_rating, get_reviews_page,
+    encode_review_cursor, decode_review_cursor
 )
+from services.selection_store import set_selected_printer
+from services.printer_directory import printer_directory
 
 router = Router()
 
@@ -21,8 +25,6 @@ class PrinterSelection(StatesGroup):
     choosing_importance = State()
     choosing_type = State()
 
-user_printer_selection = {}
-
 printer_types = {
     "printer_type_laser_bw": "Лазерный ч/б",
     "printer_type_laser_color": "Лазерный ч/б + цвет",
@@ -64,7 +66,7 @@ async def choose_printer_type(call: CallbackQuery, state: FSMContext):
     await state.set_state(PrinterSelection.choosing_type)
 
 
-# 🔹 Фильтрация исполнителей по типу принтера (по частичному совпадению)
+# 🔹 Фильтрация исполнителей по типу принтера (по возможностям принтера)
 @router.callback_query(F.data.startswith("select_type_"))
 async def filter_printers_by_type(call: CallbackQuery):
     selected_key = call.data.replace("select_type_", "")  # Получаем ключ типа принтера
@@ -74,59 +76,63 @@ async def filter_printers_by_type(call: CallbackQuery):
         await call.message.edit_text("Ошибка: выбранный тип принтера не найден.")
         return
 
-    printers = await get_all_printers()
-
-    # Фильтруем по частичному совпадению
-    filtered_printers = [p for p in printers if p.get("printer_type") and selected_type in p["printer_type"]]
+    view = await printer_directory.page_view(selected_key.replace("printer_type_", ""))
 
-    if not filtered_printers:
+    if not view:
         await call.message.edit_text("Нет исполнителей с выбранным типом принтера. Попробуйте позже.")
         return
 
-    printer_list_text = "\n\n".join([
-        f"👤 {p['full_name']} | 🏠 {p['room_number']} | 💰 {p['price_per_page']} руб.\n🖨 {p['printer_type']}"
-        for p in filtered_printers
-    ])
-
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text=f"{p['full_name']}", callback_data=f"printer_{p['chat_id']}")]
-            for p in filtered_printers
-        ]
-    )
-
-    await call.message.edit_text(f"Выберите исполнителя для печати:\n\n{printer_list_text}", reply_markup=keyboard)
+    text, keyboard = view
+    await call.message.edit_text(text, reply_markup=keyboard)
 
 
 # 🔹 Показать всех исполнителей
 @router.callback_query(F.data == "printer_show_all")
 async def show_all_printers(call: CallbackQuery):
-    printers = await get_all_printers()
+    view = await printer_directory.page_view()
 
-    if not printers:
+    if not view:
         await call.message.edit_text("Сейчас нет доступных исполнителей. Попробуйте позже.")
         return
 
-    printer_list_text = "\n\n".join([
-        f"👤 {p['full_name']} | 🏠 {p['room_number']} | 💰 {p['price_per_page']} руб.(ч/б) | 💰 {p['price_per_page_color']} руб.(цвет)\n🖨 {p['printer_type']}"
-        for p in printers
-    ])
+    text, keyboard = view
+    await call.message.edit_text(text, reply_markup=keyboard)
 
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text=f"{p['full_name']}", callback_data=f"printer_{p['chat_id']}")]
-            for p in printers
-        ]
-    )
 
-    await call.message.edit_text(f"Выберите исполнителя для печати:\n\n{printer_list_text}", reply_markup=keyboard)
+# 🔹 Листание и сортировка списка исполнителей
+@router.callback_query(F.data.startswith("pl:"))
+async def paginate_printers(call: CallbackQuery):
+    parts = call.data.split(":")
+
+    if len(parts) != 5 or (parts[1] != "all" and f"printer_type_{parts[1]}" not in printer_types):
+        await call.answer("❌ Ошибка: Некорректные данные.", show_alert=True)
+        return
+
+    _, type_filter, sort, direction, cursor = parts
+    view = await printer_directory.page_view(type_filter, sort, direction, int(cursor))
+
+    if not view:
+        # Курсор устарел (исполнитель удален или стал неактивен) — возвращаемся к первой странице
+        view = await printer_directory.page_view(type_filter, sort)
+
+    if not view:
+        await call.message.edit_text("Сейчас нет доступных исполнителей. Попробуйте позже.")
+        return
+
+    text, keyboard = view
+    try:
+        await call.message.edit_text(text, reply_markup=keyboard)
+    except TelegramBadRequest:
+        # Сообщение не изменилось (повторное нажатие той же сортировки)
+        pass
+    await call.answer()
 
 
 # 🔹 Выбор исполнителя
 @router.callback_query(F.data.startswith("printer_"))
-async def select_printer(call: CallbackQuery, bot: Bot):
+async def select_printer(call: CallbackQuery, state: FSMContext, bot: Bot):
     printer_chat_id = int(call.data.split("_")[1])
-    user_printer_selection[call.from_user.id] = printer_chat_id
+    await set_selected_printer(call.from_user.id, printer_chat_id, state)
 
     printer_info = await bot.get_chat(printer_chat_id)
 
@@ -139,7 +145,7 @@ async def select_printer(call: CallbackQuery, bot: Bot):
     await call.message.delete()
     await call.message.answer(
         f"Вы выбрали исполнителя. Теперь отправьте файл для печати.\n"
-        "Для корректного подсчета стоимости рекомендовано отправлять файлы .pdf формата.\n"
+        "Принимаются PDF, изображения JPEG/PNG и офисные документы; точнее всего стоимость считается для PDF.\n"
         f"Если у Вас есть вопросы, Вы можете обратиться в ЛС исполнителя - @{printer_info.username or printer_info.full_name}",
         reply_markup=view_profile_btn
     )
@@ -149,13 +155,13 @@ async def select_printer(call: CallbackQuery, bot: Bot):
 @router.callback_query(F.data.startswith("view_profile_"))
 async def view_profile(call: CallbackQuery):
     printer_id = int(call.data.split("_")[2])
-    info = await get_printer_info(printer_id)
+    info = await get_printer_profile(printer_id)
 
     if not info:
         await call.message.answer("❌ Ошибка: Исполнитель не найден.")
         return
 
-    avg_rating = await get_average_rating(printer_id)
+    avg_rating = format_rating(info["rating_sum"], info["rating_count"])
 
     profile_buttons = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -185,19 +191,29 @@ async def view_reviews(call: CallbackQuery):
         return
 
     printer_id = int(parts[2])
-    page = int(parts[3]) if len(parts) > 3 else 0
+    reviews_per_page = 3
 
-    reviews = await get_reviews(printer_id, limit = 15)
-    total_reviews = len(reviews)
+    # Формат: view_reviews_<printer_id>_<n|p>_<created_at>_<id>; без курсора — первая страница
+    cursor = decode_review_cursor(parts[4], parts[5]) if len(parts) >= 6 else (None, None)
+    backwards = len(parts) >= 6 and parts[3] == "p"
 
-    if total_reviews == 0:
-        await call.answer("❌ Отзывов пока нет.", show_alert=True)
+    reviews = await get_reviews_page(printer_id, *cursor, limit=reviews_per_page + 1, backwards=backwards)
+
+    if not reviews:
+        if cursor[0] is None:
+            await call.answer("❌ Отзывов пока нет.", show_alert=True)
+        else:
+            await call.answer("Больше отзывов нет.")
         return
 
-    reviews_per_page = 3
-    start_index = page * reviews_per_page
-    end_index = start_index + reviews_per_page
-    reviews_on_page = reviews[start_index:end_index]
+    # Лишний отзыв показывает, есть ли еще страница в направлении запроса
+    has_more = len(reviews) > reviews_per_page
+    if backwards:
+        reviews_on_page = reviews[-reviews_per_page:]
+        has_prev, has_next = has_more, True
+    else:
+        reviews_on_page = reviews[:reviews_per_page]
+        has_prev, has_next = cursor[0] is not None, has_more
 
     review_texts = []
     for review in reviews_on_page:
@@ -208,10 +224,18 @@ async def view_reviews(call: CallbackQuery):
     reviews_text = "\n\n".join(review_texts)
 
     buttons = []
-    if start_index > 0:
-        buttons.append(InlineKeyboardButton(text="◀ Назад", callback_data=f"view_reviews_{printer_id}_{page - 1}"))
-    if end_index < total_reviews:
-        buttons.append(InlineKeyboardButton(text="Вперед ▶", callback_data=f"view_reviews_{printer_id}_{page + 1}"))
+    if has_prev:
+        first = reviews_on_page[0]
+        buttons.append(InlineKeyboardButton(
+            text="◀ Назад",
+            callback_data=f"view_reviews_{printer_id}_p_{encode_review_cursor(first['created_at'], first['id'])}"
+        ))
+    if has_next:
+        last = reviews_on_page[-1]
+        buttons.append(InlineKeyboardButton(
+            text="Вперед ▶",
+            callback_data=f"view_reviews_{printer_id}_n_{encode_review_cursor(last['created_at'], last['id'])}"
+        ))
 
     buttons.append(InlineKeyboardButton(text="❌ Закрыть", callback_data="close_reviews"))
 
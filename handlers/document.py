@@ -1,13 +1,29 @@
+import asyncio
 import logging
-import fitz
-import time
+import os
+from contextlib import AsyncExitStack
+from decimal import InvalidOperation
 from aiogram import Router, F, Bot
-from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from aiogram.types import (
+    Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, InputMediaDocument, FSInputFile
+)
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from handlers.callback import user_printer_selection
-from database.database import get_printer_room, get_printer_info, add_review, get_average_rating, update_printer_stats
+from database.database import (
+    get_printer_room, add_review, create_order, mark_order_sent, complete_order, reject_order_by_printer
+)
+from services.pdf_engine import PdfTooLargeError, PdfEngineBusyError, PDF_MAX_FILE_SIZE
+from services.ingest import analyze_document_file, document_kind, DocumentConversionError
+from services.document_cache import get_document, put_document
+from services.selection_store import get_selected_printer, get_printer_snapshot
+from services.sender import scheduler
+from services.pricing import (
+    PRINT_TYPE_TITLES, PAGES_PER_SHEET, money, add_to_totals, apply_print_type, empty_totals,
+    parse_page_range, print_options, reprice, set_print_options
+)
+from services.print_layout import can_bundle, needs_layout, print_file, bundle_file
+from services.media_group import MediaGroupCollector
 
 router = Router()
 
@@ -17,6 +33,7 @@ logger = logging.getLogger(__name__)
 class PrintRequest(StatesGroup):
     waiting_print_type = State()
     waiting_for_requirements = State()
+    waiting_for_page_range = State()
 
 class PaymentState(StatesGroup):
     choosing_payment_method = State()
@@ -25,68 +42,182 @@ class PaymentState(StatesGroup):
 class RatingState(StatesGroup):
     waiting_for_comment = State()
 
-async def get_pdf_page_count(file_id, bot):
+async def get_document_analysis(document, bot):
+    """Количество страниц и номера цветных страниц; (0, None) при ошибке разбора"""
     try:
-        file = await bot.get_file(file_id)
-        file_path = file.file_path
-        file_bytes = await bot.download_file(file_path)
-
-        with fitz.open("pdf", file_bytes.read()) as doc:
-            return len(doc)
+        return await analyze_document_file(
+            bot, document.file_id, document.file_name, document.mime_type, document.file_size, document.file_unique_id
+        )
+    except (PdfTooLargeError, PdfEngineBusyError, DocumentConversionError):
+        raise
     except Exception as e:
         logger.exception(f"Ошибка при обработке PDF: {e}")
-        return 0
+        return 0, None
+
+
+def _too_large_text():
+    return f"⚠ Файл слишком большой. Максимальный размер — {PDF_MAX_FILE_SIZE // (1024 * 1024)} МБ."
+
+
+async def analyze_document(message: Message):
+    """Разбор присланного файла: ({"pages", "color_pages"}, None) или (None, текст ошибки для пользователя)"""
+    document = message.document
+
+    if document_kind(document.file_name, document.mime_type) is None:
+        return None, "⚠ Поддерживаются файлы PDF, изображения JPEG/PNG и документы Word, Excel, PowerPoint и OpenDocument."
+
+    if document.file_size and document.file_size > PDF_MAX_FILE_SIZE:
+        return None, _too_large_text()
+
+    # Повторно присланный файл не скачиваем и не разбираем заново
+    cached = await get_document(document.file_unique_id)
+    if cached:
+        return cached, None
+
+    try:
+        page_count, color_pages = await get_document_analysis(document, message.bot)
+    except PdfTooLargeError:
+        return None, _too_large_text()
+    except PdfEngineBusyError:
+        return None, "⏳ Сейчас обрабатывается слишком много файлов. Попробуйте отправить файл через минуту."
+    except DocumentConversionError as e:
+        logger.error(f"Ошибка при конвертации {document.file_name}: {e}")
+        return None, "⚠ Не удалось преобразовать файл в PDF. Сохраните его в PDF и отправьте снова."
+
+    if page_count == 0:
+        return None, "⚠ Ошибка при обработке файла. Попробуйте другой файл."
+
+    await put_document(document.file_unique_id, page_count, color_pages, document.file_size)
+    return {"pages": page_count, "color_pages": color_pages}, None
+
+
+def _document_entry(message: Message, info: dict):
+    return {
+        "file_id": message.document.file_id,
+        "file_unique_id": message.document.file_unique_id,
+        "file_name": message.document.file_name or "Без имени",
+        "mime_type": message.document.mime_type,
+        "pages": info["pages"],
+        "color_pages": info["color_pages"],
+        "print_type": None,
+    }
+
+
+def _has_mixed_pages(doc: dict):
+    """В файле есть и цветные, и Ч/Б страницы — имеет смысл постраничная цена"""
+    color_pages = doc.get("color_pages")
+    return bool(color_pages) and len(color_pages) < doc["pages"]
+
+
+def _file_print_type_prompt(index: int, doc: dict):
+    buttons = [
+        [InlineKeyboardButton(text="Ч/Б", callback_data=f"bw_{index}")],
+        [InlineKeyboardButton(text="Цвет", callback_data=f"color_{index}")],
+    ]
+    text = f"📄 {doc['file_name']} ({doc['pages']} стр.)\n"
+    if _has_mixed_pages(doc):
+        buttons.append([InlineKeyboardButton(
+            text=f"Цветные только {len(doc['color_pages'])} стр., остальные Ч/Б", callback_data=f"mixed_{index}"
+        )])
+        text += f"🎨 Цветных страниц: {len(doc['color_pages'])}\n"
+    return text + "Выберите формат печати:", InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+def _print_type_choice_keyboard(documents: list):
+    buttons = [
+        [InlineKeyboardButton(text="Все файлы Ч/Б", callback_data="all_bw")],
+        [InlineKeyboardButton(text="Все файлы Цвет", callback_data="all_color")],
+    ]
+    if any(_has_mixed_pages(doc) for doc in documents):
+        buttons.append([InlineKeyboardButton(text="Цветные только цветные страницы", callback_data="all_mixed")])
+    buttons.append([InlineKeyboardButton(text="Выбрать для каждого", callback_data="choose_each")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+async def add_documents(state: FSMContext, printer_id: int, new_documents: list):
+    """Добавление файлов в заказ, возвращает полный список документов"""
+    data = await state.get_data()
+    documents = data.get("documents", [])
+    documents.extend(new_documents)
+    await state.update_data(printer_id=printer_id, documents=documents, **add_to_totals(data, new_documents))
+    return documents
 
 
 @router.message(F.document)
 async def handle_document(message: Message, state: FSMContext):
     user_id = message.from_user.id
 
-    if user_id not in user_printer_selection:
+    printer_id = await get_selected_printer(user_id, state)
+    if printer_id is None:
         await message.answer("❌ Вы не выбрали исполнителя. Сначала выберите исполнителя перед отправкой файла.")
         return
 
-    printer_id = user_printer_selection[user_id]
-    printer_info = await get_printer_info(printer_id)
-
-    if not printer_info:
-        await message.answer("❌ Ошибка: Исполнитель не найден.")
+    # Файлы альбома обрабатываются одной пачкой
+    if message.media_group_id:
+        album_collector.add(message, state)
         return
 
-    if not message.document.file_name.lower().endswith(".pdf"):
-        await message.answer("⚠ Поддерживаются только PDF-файлы для точного подсчета стоимости.")
+    if not await get_printer_snapshot(state, printer_id):
+        await message.answer("❌ Ошибка: Исполнитель не найден.")
         return
 
-    page_count = await get_pdf_page_count(message.document.file_id, message.bot)
-    if page_count == 0:
-        await message.answer("⚠ Ошибка при обработке файла. Попробуйте другой файл.")
+    info, error = await analyze_document(message)
+    if error:
+        await message.answer(error)
         return
 
-    # Получаем текущие данные о документах
-    data = await state.get_data()
-    documents = data.get("documents", [])
-
-    await state.update_data(printer_id=printer_id)
-
-    # Добавляем новый файл в список
-    documents.append(
-        {"file_id": message.document.file_id, "file_name": message.document.file_name, "pages": page_count, "print_type": None}
-    )
-    await state.update_data(documents=documents)
+    documents = await add_documents(state, printer_id, [_document_entry(message, info)])
 
     if len(documents) == 3:
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="Все файлы Ч/Б", callback_data="all_bw")],
-            [InlineKeyboardButton(text="Все файлы Цвет", callback_data="all_color")],
-            [InlineKeyboardButton(text="Выбрать для каждого", callback_data="choose_each")],
-        ])
         await message.answer(
             "Вы загрузили 3 или более файлов. Выберите формат печати для всех сразу или для каждого отдельно:",
-            reply_markup=keyboard
+            reply_markup=_print_type_choice_keyboard(documents)
         )
-    elif len(documents) < 3:
+    else:
+        # Начиная с четвертого файла спрашиваем только про новый; всем сразу — кнопкой «Формат печати»
         await ask_print_type_for_file(message, len(documents) - 1, state)
 
+
+async def handle_album(messages: list, state: FSMContext):
+    """Обработка альбома: исполнитель проверяется один раз, файлы считаются параллельно, ответ — один"""
+    first = messages[0]
+
+    printer_id = await get_selected_printer(first.from_user.id, state)
+    if printer_id is None or not await get_printer_snapshot(state, printer_id):
+        await first.answer("❌ Ошибка: Исполнитель не найден.")
+        return
+
+    results = await asyncio.gather(*[analyze_document(m) for m in messages])
+
+    new_documents = []
+    lines = []
+    for message, (info, error) in zip(messages, results):
+        if error:
+            lines.append(f"❌ {message.document.file_name}: {error}")
+        else:
+            new_documents.append(_document_entry(message, info))
+            color = f", цветных: {len(info['color_pages'])}" if info["color_pages"] else ""
+            lines.append(f"📄 {message.document.file_name} — {info['pages']} стр.{color}")
+
+    if not new_documents:
+        await first.answer("⚠ Не удалось обработать файлы альбома:\n\n" + "\n".join(lines))
+        return
+
+    documents = await add_documents(state, printer_id, new_documents)
+    summary = f"📥 Получено файлов: {len(new_documents)} из {len(messages)}\n\n" + "\n".join(lines)
+
+    if len(documents) == 1:
+        await first.answer(summary)
+        await ask_print_type_for_file(first, 0, state)
+    else:
+        await first.answer(
+            f"{summary}\n\nВыберите формат печати для всех файлов сразу или для каждого отдельно:",
+            reply_markup=_print_type_choice_keyboard(documents)
+        )
+
+
+album_collector = MediaGroupCollector(handle_album)
+
 async def ask_print_type_for_file(message: Message, index: int, state: FSMContext):
     data = await state.get_data()
     documents = data.get("documents", [])
@@ -94,104 +225,138 @@ async def ask_print_type_for_file(message: Message, index: int, state: FSMContex
     if index >= len(documents):
         return
 
-    doc = documents[index]
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Ч/Б", callback_data=f"bw_{index}")],
-        [InlineKeyboardButton(text="Цвет", callback_data=f"color_{index}")],
-    ])
+    text, keyboard = _file_print_type_prompt(index, documents[index])
+    await message.answer(text, reply_markup=keyboard)
 
-    await message.answer(
-        f"📄 {doc['file_name']} ({doc['pages']} стр.)\nВыберите формат печати:",
-        reply_markup=keyboard
-    )
+NEXT_STEP_TEXT = (
+    "Загрузите следующий файл или настройте параметры печати.\n"
+    "Если вы отправили не тот файл, напишите /start и начните отправку снова."
+)
 
-@router.callback_query(F.data == "all_bw")
-async def set_all_bw(call: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    documents = data.get("documents", [])
-    printer_info = await get_printer_info(data.get("printer_id"))
+# Сколько файлов перечислять в сообщении с параметрами печати
+OPTIONS_FILES_SHOWN = 10
 
-    if not printer_info:
-        await call.message.answer("❌ Ошибка: Не удалось получить информацию о принтере.")
-        return
 
-    price_per_page = printer_info.get("price_per_page", 0.25)  # Цена за Ч/Б страницу
-    total_pages = 0
-    total_price = 0
-    summary_message = ""
-
-    for doc in documents:
-        doc["print_type"] = "bw"
-        doc["cost"] = round(doc["pages"] * price_per_page, 2)  # Пересчитываем стоимость
-        total_pages += doc["pages"]
-        total_price += doc["cost"]
-
-        summary_message += (
-            f"📄 Файл: {doc['file_name']}\n"
-            f"📑 Страниц в файле: {doc['pages']}\n"
-            f"🎨 Формат печати: Ч/Б\n"
-            f"💰 Стоимость файла: {doc['cost']} руб.\n\n"
-        )
+def _document_summary(doc: dict):
+    return (
+        f"📄 Файл: {doc['file_name']}\n"
+        f"📑 Страниц в файле: {doc['pages']}\n"
+        f"🎨 Формат печати: {PRINT_TYPE_TITLES[doc['print_type']]}\n"
+        + (f"🖍 Цветных страниц: {len(doc['color_pages'])}\n" if doc["print_type"] == "mixed" else "")
+        + f"💰 Стоимость файла: {doc['cost']} руб.\n\n"
+    )
+
 
-    summary_message += (
+def _totals_summary(total_pages: int, total_price: str):
+    return (
         f"📊 Общий подсчет:\n"
         f"📑 Всего страниц: {total_pages}\n"
         f"💵 Итоговая стоимость: {total_price} руб.\n\n"
-        "Загрузите следующий файл или напишите дополнительные требования к распечатке.\n"
-        "Напишите 'нет', если у вас нет дополнительных требований.\n"
-        "Если вы отправили не тот файл, напишите /start и начните отправку снова."
     )
 
-    await state.update_data(documents=documents, total_pages=total_pages, total_price=total_price)
-    await call.message.answer(summary_message)
-    await call.message.delete()
-    await call.answer()
-    await state.set_state(PrintRequest.waiting_for_requirements)
 
+def _options_view(data: dict):
+    """Сообщение с параметрами печати заказа и клавиатура для их изменения"""
+    documents = data.get("documents", [])
+    pages_per_sheet, duplex = print_options(data)
+
+    lines = ["⚙ Параметры печати\n"]
+    for number, doc in enumerate(documents[:OPTIONS_FILES_SHOWN], start=1):
+        lines.append(f"{number}. {doc['file_name']} — страницы: {doc.get('page_range') or 'все'}")
+    if len(documents) > OPTIONS_FILES_SHOWN:
+        lines.append(f"… и еще файлов: {len(documents) - OPTIONS_FILES_SHOWN}")
+
+    lines.append("")
+    lines.append(f"🗂 Страниц на стороне листа: {pages_per_sheet}")
+    lines.append(f"📑 Двусторонняя печать: {'да' if duplex else 'нет'}")
+    if data.get("bundle") and can_bundle(documents):
+        lines.append("📎 Исполнитель получит все файлы одним PDF")
+    if data.get("requirements"):
+        lines.append(f"✍ Комментарий: {data['requirements']}")
+    lines.append(f"🧾 Сторон листа: {data.get('total_pages', 0)}, листов: {data.get('total_sheets', 0)}")
+    lines.append(f"💵 Итоговая стоимость: {money(data.get('total_price'))} руб.")
 
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📑 Выбрать страницы", callback_data="opt_range")],
+        [InlineKeyboardButton(text="🎨 Формат печати", callback_data="opt_print_type")],
+        [
+            InlineKeyboardButton(text=f"{'✅ ' if pages_per_sheet == n else ''}{n} на листе", callback_data=f"opt_nup_{n}")
+            for n in PAGES_PER_SHEET
+        ],
+        [InlineKeyboardButton(text=f"Двусторонняя: {'да' if duplex else 'нет'}", callback_data="opt_duplex")],
+        *([[InlineKeyboardButton(
+            text=f"Одним файлом: {'да' if data.get('bundle') else 'нет'}", callback_data="opt_bundle"
+        )]] if can_bundle(documents) else []),
+        [InlineKeyboardButton(text="✍ Комментарий исполнителю", callback_data="opt_comment")],
+        [InlineKeyboardButton(text="➡ Перейти к оплате", callback_data="opt_done")],
+    ])
+    return "\n".join(lines), keyboard
 
-@router.callback_query(F.data == "all_color")
-async def set_all_color(call: CallbackQuery, state: FSMContext):
+
+async def show_print_options(message: Message, state: FSMContext):
+    text, keyboard = _options_view(await state.get_data())
+    await message.answer(text, reply_markup=keyboard)
+
+
+def _options_summary(data: dict):
+    """Параметры печати для исполнителя"""
+    pages_per_sheet, duplex = print_options(data)
+    return (
+        f"🗂 Страниц на стороне листа: {pages_per_sheet}\n"
+        f"📑 Двусторонняя печать: {'да' if duplex else 'нет'}\n"
+        f"🧾 Сторон листа: {data.get('total_pages', 0)}, листов: {data.get('total_sheets', 0)}\n"
+    )
+
+
+async def set_print_type(call: CallbackQuery, state: FSMContext, print_type: str, index: int = None):
+    """Формат печати для одного файла (index) или для всех файлов заказа"""
     data = await state.get_data()
     documents = data.get("documents", [])
-    printer_info = await get_printer_info(data.get("printer_id"))
 
-    if not printer_info:
+    if index is not None and index >= len(documents):
+        await call.message.answer("❌ Ошибка: Файл не найден.")
+        return
+
+    prices = await get_printer_snapshot(state, data.get("printer_id"), data)
+
+    if not prices:
         await call.message.answer("❌ Ошибка: Не удалось получить информацию о принтере.")
         return
 
-    price_per_page_color = printer_info.get("price_per_page_color", 0.6)
-    total_pages = 0
-    total_price = 0
-    summary_message = ""
-
-    for doc in documents:
-        doc["print_type"] = "color"
-        doc["cost"] = round(doc["pages"] * price_per_page_color, 2)
-        total_pages += doc["pages"]
-        total_price += doc["cost"]
-
-        summary_message += (
-            f"📄 Файл: {doc['file_name']}\n"
-            f"📑 Страниц в файле: {doc['pages']}\n"
-            f"🎨 Формат печати: Цвет\n"
-            f"💰 Стоимость файла: {doc['cost']} руб.\n\n"
-        )
+    indexes = range(len(documents)) if index is None else [index]
+    update = apply_print_type(data, indexes, print_type, prices)
+    await state.update_data(**update)
 
-    summary_message += (
-        f"📊 Общий подсчет:\n"
-        f"📑 Всего страниц: {total_pages}\n"
-        f"💵 Итоговая стоимость: {total_price} руб.\n\n"
-        "Загрузите следующий файл или напишите дополнительные требования к распечатке.\n"
-        "Напишите 'нет', если у вас нет дополнительных требований.\n"
-        "Если вы отправили не тот файл, напишите /start и начните отправку снова."
+    # Сообщение Telegram ограничено 4096 символами: перечисляем только первые файлы
+    summary = "".join(_document_summary(documents[i]) for i in indexes[:OPTIONS_FILES_SHOWN])
+    if len(indexes) > OPTIONS_FILES_SHOWN:
+        summary += f"… и еще файлов: {len(indexes) - OPTIONS_FILES_SHOWN}\n\n"
+    await call.message.answer(
+        summary + _totals_summary(update["total_pages"], update["total_price"]) + NEXT_STEP_TEXT
     )
-
-    await state.update_data(documents=documents, total_pages=total_pages, total_price=total_price)
-    await call.message.answer(summary_message)
     await call.message.delete()
     await call.answer()
-    await state.set_state(PrintRequest.waiting_for_requirements)
+
+    # Параметры печати показываем, когда формат выбран для всех файлов
+    if all(doc.get("print_type") for doc in documents):
+        await state.set_state(None)
+        await show_print_options(call.message, state)
+
+
+@router.callback_query(F.data == "all_bw")
+async def set_all_bw(call: CallbackQuery, state: FSMContext):
+    await set_print_type(call, state, "bw")
+
+
+@router.callback_query(F.data == "all_color")
+async def set_all_color(call: CallbackQuery, state: FSMContext):
+    await set_print_type(call, state, "color")
+
+
+@router.callback_query(F.data == "all_mixed")
+async def set_all_mixed(call: CallbackQuery, state: FSMContext):
+    await set_print_type(call, state, "mixed")
+
 
 @router.callback_query(F.data == "choose_each")
 async def choose_each_file(call: CallbackQuery, state: FSMContext):
@@ -199,15 +364,8 @@ async def choose_each_file(call: CallbackQuery, state: FSMContext):
     documents = data.get("documents", [])
 
     for index, doc in enumerate(documents):
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="Ч/Б", callback_data=f"bw_{index}")],
-            [InlineKeyboardButton(text="Цвет", callback_data=f"color_{index}")],
-        ])
-
-        await call.message.answer(
-            f"📄 {doc['file_name']} ({doc['pages']} стр.)\nВыберите формат печати:",
-            reply_markup=keyboard
-        )
+        text, keyboard = _file_print_type_prompt(index, doc)
+        await call.message.answer(text, reply_markup=keyboard)
 
     await call.message.delete()
     await call.answer()
@@ -215,150 +373,208 @@ async def choose_each_file(call: CallbackQuery, state: FSMContext):
 
 @router.callback_query(F.data == "back_to_upload")
 async def back_to_upload(call: CallbackQuery, state: FSMContext):
-    await state.update_data(documents=[])
+    # Новый черновик — цены исполнителя зафиксируются заново при первом файле
+    await state.update_data(printer_snapshot=None, **empty_totals())
     await call.message.answer("📤 Загрузите новый файл для печати.")
     await call.message.delete()
     await call.answer()
 
 
-async def update_total_price(state: FSMContext):
-    data = await state.get_data()
-    documents = data.get("documents", [])
+@router.callback_query(F.data.startswith("bw_"))
+async def choose_bw(call: CallbackQuery, state: FSMContext):
+    await set_print_type(call, state, "bw", int(call.data.split("_")[1]))
 
-    total_price = round(sum(float(doc.get("cost", 0)) for doc in documents), 2)
-    total_pages = sum(doc.get("pages", 0) for doc in documents)
 
-    await state.update_data(total_pages=total_pages, total_price=total_price)
+@router.callback_query(F.data.startswith("color_"))
+async def choose_color(call: CallbackQuery, state: FSMContext):
+    await set_print_type(call, state, "color", int(call.data.split("_")[1]))
 
-@router.callback_query(F.data.startswith("bw_"))
-async def choose_bw(call: CallbackQuery, state: FSMContext):
-    index = int(call.data.split("_")[1])
+
+@router.callback_query(F.data.startswith("mixed_"))
+async def choose_mixed(call: CallbackQuery, state: FSMContext):
+    await set_print_type(call, state, "mixed", int(call.data.split("_")[1]))
+
+
+@router.callback_query(F.data == "opt_print_type")
+async def ask_print_types(call: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     documents = data.get("documents", [])
 
-    if index >= len(documents):
-        await call.message.answer("❌ Ошибка: Файл не найден.")
+    if not documents:
+        await call.answer("В заказе нет файлов.", show_alert=True)
         return
 
-    printer_id = data.get("printer_id")
-    printer_info = await get_printer_info(printer_id)
+    await call.message.answer(
+        "Выберите формат печати для всех файлов сразу или для каждого отдельно:",
+        reply_markup=_print_type_choice_keyboard(documents)
+    )
+    await call.answer()
+
+
+async def _change_options(call: CallbackQuery, state: FSMContext, **options):
+    data = await state.get_data()
+    prices = await get_printer_snapshot(state, data.get("printer_id"), data)
 
-    if not printer_info:
+    if not prices:
         await call.message.answer("❌ Ошибка: Не удалось получить информацию о принтере.")
         return
 
-    price_per_page = printer_info.get("price_per_page", 0.25)
+    update = set_print_options(data, prices, **options)
+    await state.update_data(**update)
+    data.update(update)
 
-    documents[index]["print_type"] = "bw"
-    documents[index]["cost"] = round(documents[index]["pages"] * price_per_page, 2)
+    text, keyboard = _options_view(data)
+    try:
+        await call.message.edit_text(text, reply_markup=keyboard)
+    except TelegramBadRequest:
+        # Сообщение не изменилось (повторное нажатие того же варианта)
+        pass
+    await call.answer()
 
-    await state.update_data(documents=documents)
-    await update_total_price(state)
 
-    # ✅ Удаляем сообщение с кнопками
-    await call.message.delete()
+@router.callback_query(F.data.startswith("opt_nup_"))
+async def set_pages_per_sheet(call: CallbackQuery, state: FSMContext):
+    pages_per_sheet = int(call.data.split("_")[2])
+    if pages_per_sheet not in PAGES_PER_SHEET:
+        await call.answer()
+        return
+    await _change_options(call, state, pages_per_sheet=pages_per_sheet)
 
-    # ✅ Получаем обновленные данные
-    updated_data = await state.get_data()
-    total_pages = updated_data.get("total_pages", 0)
-    total_price = updated_data.get("total_price", 0)
 
-    await call.message.answer(
-        f"📄 Файл {documents[index]['file_name']} принят.\n"
-        f"📑 Страниц в файле: {documents[index]['pages']}\n"
-        f"🎨 Формат печати: Ч/Б\n"
-        f"💰 Стоимость файла: {documents[index]['cost']} руб.\n\n"
-        f"📊 Общий подсчет:\n"
-        f"📑 Всего страниц: {total_pages}\n"
-        f"💵 Итоговая стоимость: {total_price} руб.\n\n"
-        "Загрузите следующий файл или напишите дополнительные требования к распечатке, напишите 'нет', если у Вас нет дополнительных требований."
-        "Если Вы отправили не тот файл, напишите /start и начните отправку снова."
-    )
+@router.callback_query(F.data == "opt_duplex")
+async def toggle_duplex(call: CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    await _change_options(call, state, duplex=not data.get("duplex", False))
+
+
+@router.callback_query(F.data == "opt_bundle")
+async def toggle_bundle(call: CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    if not can_bundle(data.get("documents", [])):
+        await call.answer("Одним файлом можно отправить только файлы с одинаковым форматом печати: все Ч/Б или все цветные.", show_alert=True)
+        return
+
+    data["bundle"] = not data.get("bundle", False)
+    await state.update_data(bundle=data["bundle"])
+
+    text, keyboard = _options_view(data)
+    await call.message.edit_text(text, reply_markup=keyboard)
     await call.answer()
-    await state.set_state(PrintRequest.waiting_for_requirements)
 
 
-@router.callback_query(F.data.startswith("color_"))
-async def choose_color(call: CallbackQuery, state: FSMContext):
-    index = int(call.data.split("_")[1])
+@router.callback_query(F.data == "opt_range")
+async def ask_page_range(call: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     documents = data.get("documents", [])
 
-    if index >= len(documents):
-        await call.message.answer("❌ Ошибка: Файл не найден.")
+    if not documents:
+        await call.answer("Сначала загрузите файл.")
         return
 
-    printer_id = data.get("printer_id")
-    printer_info = await get_printer_info(printer_id)
+    if len(documents) == 1:
+        text = "📑 Введите страницы для печати, например: 1-3, 5\nЧтобы печатать все страницы, напишите 'все'."
+    else:
+        text = (
+            "📑 Введите номер файла из списка и страницы для печати, например: 2: 1-3, 5\n"
+            "Чтобы печатать все страницы файла, напишите, например: 2: все"
+        )
+    await call.message.answer(text)
+    await call.answer()
+    await state.set_state(PrintRequest.waiting_for_page_range)
 
-    if not printer_info:
-        await call.message.answer("❌ Ошибка: Не удалось получить информацию о принтере.")
-        return
 
-    price_per_page_color = printer_info.get("price_per_page_color", 0.6)
+@router.message(PrintRequest.waiting_for_page_range)
+async def set_page_range(message: Message, state: FSMContext):
+    data = await state.get_data()
+    documents = data.get("documents", [])
+    text = (message.text or "").strip()
+
+    index = 0
+    if len(documents) > 1:
+        number, colon, text = text.partition(":")
+        if not colon or not number.strip().isdigit() or not 1 <= int(number) <= len(documents):
+            await message.answer(f"❌ Укажите номер файла от 1 до {len(documents)}, например: 2: 1-3, 5")
+            return
+        index = int(number) - 1
+        text = text.strip()
 
-    documents[index]["print_type"] = "color"
-    documents[index]["cost"] = round(documents[index]["pages"] * price_per_page_color, 2)
+    doc = documents[index]
+    if text.lower() == "все":
+        page_range = None
+    else:
+        try:
+            parse_page_range(text, doc["pages"])
+        except ValueError:
+            await message.answer(f"❌ Не удалось разобрать страницы. В файле {doc['pages']} стр.; пример: 1-3, 5")
+            return
+        page_range = text.replace(" ", "").replace(",", ", ")
 
-    await state.update_data(documents=documents)
-    await update_total_price(state)
+    prices = await get_printer_snapshot(state, data.get("printer_id"), data)
+    if not prices:
+        await message.answer("❌ Ошибка: Не удалось получить информацию о принтере.")
+        return
 
-    # ✅ Удаляем сообщение с кнопками
-    await call.message.delete()
+    doc["page_range"] = page_range
+    await state.update_data(**reprice(data, [index], prices))
+    await state.set_state(None)
+    await show_print_options(message, state)
 
-    # ✅ Получаем обновленные данные
-    updated_data = await state.get_data()
-    total_pages = updated_data.get("total_pages", 0)
-    total_price = updated_data.get("total_price", 0)
 
-    await call.message.answer(
-        f"📄 Файл {documents[index]['file_name']} принят.\n"
-        f"📑 Страниц в файле: {documents[index]['pages']}\n"
-        f"🎨 Формат печати: Цвет\n"
-        f"💰 Стоимость файла: {documents[index]['cost']} руб.\n\n"
-        f"📊 Общий подсчет:\n"
-        f"📑 Всего страниц: {total_pages}\n"
-        f"💵 Итоговая стоимость: {total_price} руб.\n\n"
-        "Загрузите следующий файл или напишите дополнительные требования к распечатке, напишите 'нет', если у Вас нет дополнительных требований."
-        "Если Вы отправили не тот файл, напишите /start и начните отправку снова."
-    )
+@router.callback_query(F.data == "opt_comment")
+async def ask_comment(call: CallbackQuery, state: FSMContext):
+    await call.message.answer("✍ Напишите комментарий для исполнителя или 'нет', если его нет.")
     await call.answer()
     await state.set_state(PrintRequest.waiting_for_requirements)
 
 
 @router.message(PrintRequest.waiting_for_requirements)
-async def ask_payment_method(message: Message, state: FSMContext):
-    await state.update_data(requirements=message.text.strip())
+async def set_comment(message: Message, state: FSMContext):
+    comment = (message.text or "").strip()
+    await state.update_data(requirements=None if comment.lower() == "нет" else comment)
+    await state.set_state(None)
+    await show_print_options(message, state)
+
+
+@router.callback_query(F.data == "opt_done")
+async def ask_payment_method(call: CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    documents = data.get("documents", [])
+
+    if not documents or not all(doc.get("print_type") for doc in documents):
+        await call.answer("Выберите формат печати для всех файлов (кнопка «🎨 Формат печати»).", show_alert=True)
+        return
+
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="💳 Картой", callback_data="pay_card")],
         [InlineKeyboardButton(text="💵 Наличными", callback_data="pay_cash")],
         [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_requirements")]
     ])
-    await message.answer("Выберите способ оплаты:", reply_markup=keyboard)
+    await call.message.answer("Выберите способ оплаты:", reply_markup=keyboard)
+    await call.answer()
     await state.set_state(PaymentState.choosing_payment_method)
 
 @router.callback_query(F.data == "back_to_requirements")
 async def back_to_requirements(call: CallbackQuery, state: FSMContext):
-    await call.message.answer("✍ Введите дополнительные требования к печати или напишите 'нет', если их нет.")
     await call.message.delete()
     await call.answer()
-    await state.set_state(PrintRequest.waiting_for_requirements)
+    await state.set_state(None)
+    await show_print_options(call.message, state)
 
 
 @router.callback_query(F.data == "pay_card")
 async def handle_card_payment(call: CallbackQuery, state: FSMContext):
     data = await state.get_data()
-    total_price = data.get("total_price", 0)
+    total_price = money(data.get("total_price"))
     printer_id = data.get("printer_id")
 
     if not printer_id:
         await call.message.answer("Не выбран исполнитель.")
         return
 
-    printer_info = await get_printer_info(printer_id)
+    prices = await get_printer_snapshot(state, printer_id, data)
 
-    if printer_info and printer_info.get("card_number"):
-        card_number = printer_info["card_number"]
+    if prices and prices.get("card_number"):
+        card_number = prices["card_number"]
         await call.message.answer(f"💳 Оплата картой: {total_price} руб. Оплатите заказ по реквизитам исполнителя: {card_number}")
     else:
         await call.message.answer("Нет номера карточки у исполнителя")
@@ -377,21 +593,83 @@ async def ask_cash_amount(call: CallbackQuery, state: FSMContext):
 @router.message(PaymentState.entering_cash_amount)
 async def handle_cash_payment(message: Message, state: FSMContext):
     try:
-        amount_given = float(message.text.replace(",", "."))
-        data = await state.get_data()
-        total_price = data.get("total_price", 0)
+        amount_given = money(message.text.replace(",", ".").strip())
+    except InvalidOperation:
+        amount_given = None
 
-        if amount_given < total_price:
-            await message.answer("❌ Недостаточная сумма. Введите корректную сумму.")
-            return
+    if amount_given is None or not amount_given.is_finite():
+        await message.answer("❌ Пожалуйста, введите корректную сумму (числом).")
+        return
+
+    data = await state.get_data()
+    total_price = money(data.get("total_price"))
 
-        change = round(float(amount_given) - float(total_price), 2)
-        payment_info = f"💵 Оплата наличными: {amount_given} руб.\n💰 Сдача: {change} руб."
+    if amount_given < total_price:
+        await message.answer("❌ Недостаточная сумма. Введите корректную сумму.")
+        return
 
-        await send_order_to_printer(message, state, payment_info)
+    change = amount_given - total_price
+    payment_info = f"💵 Оплата наличными: {amount_given} руб.\n💰 Сдача: {change} руб."
+
+    await send_order_to_printer(message, state, payment_info)
 
-    except ValueError:
-        await message.answer("❌ Пожалуйста, введите корректную сумму (числом).")
+
+def _file_caption(doc: dict):
+    pages = f", страницы: {doc['page_range']}" if doc.get("page_range") else ""
+    return (
+        f"📄 {doc['file_name']} - {doc['pages']} стр.{pages} "
+        f"({PRINT_TYPE_TITLES.get(doc['print_type'], 'формат не выбран')})"
+    )
+
+
+async def _order_media(bot: Bot, files: AsyncExitStack, doc: dict, pages_per_sheet: int):
+    """Документ для отправки исполнителю: исходный файл или подготовленный PDF с выбранными страницами и раскладкой"""
+    if needs_layout(doc, pages_per_sheet):
+        try:
+            path = await files.enter_async_context(print_file(bot, doc, pages_per_sheet))
+            name = os.path.splitext(doc["file_name"])[0] + ".pdf"
+            return InputMediaDocument(media=FSInputFile(path, filename=name), caption=_file_caption(doc))
+        except Exception as e:
+            # Исполнитель получит исходный файл, а параметры печати — в подписи
+            logger.error(f"Не удалось подготовить файл {doc['file_name']} к печати: {e}")
+    return InputMediaDocument(media=doc["file_id"], caption=_file_caption(doc))
+
+
+async def _send_files(bot: Bot, printer_id: int, document_list: list, pages_per_sheet: int):
+    async with AsyncExitStack() as files:
+        # Файлы с выбранными страницами или раскладкой по несколько на лист готовим заново
+        media = await asyncio.gather(*[
+            _order_media(bot, files, doc, pages_per_sheet) for doc in document_list
+        ])
+
+        # ✅ Разбиваем файлы на группы по 10; группы одного чата отправляем по очереди, чтобы сохранить порядок файлов
+        batch_size = 10
+        for i in range(0, len(media), batch_size):
+            media_group = media[i:i + batch_size]
+            await scheduler.call(
+                printer_id, bot.send_media_group, chat_id=printer_id, media=media_group, cost=len(media_group)
+            )
+
+
+async def _send_bundle(bot: Bot, printer_id: int, order_id: int, document_list: list, pages_per_sheet: int, duplex: bool):
+    """Все файлы заказа одним PDF с разделителями; False, если собрать файл не удалось"""
+    built = False
+    try:
+        titles = [_file_caption(doc) for doc in document_list]
+        async with bundle_file(bot, document_list, titles, pages_per_sheet, duplex) as path:
+            built = True
+            await scheduler.call(
+                printer_id, bot.send_document, chat_id=printer_id,
+                document=FSInputFile(path, filename=f"Заказ_{order_id}.pdf"),
+                caption=f"📎 Заказ №{order_id}: все файлы одним PDF, перед каждым файлом — лист-разделитель"
+            )
+        return True
+    except Exception as e:
+        if built:
+            # Ошибка отправки, а не сборки — повторять файлами по отдельности нельзя
+            raise
+        logger.error(f"Не удалось собрать общий файл заказа №{order_id}, файлы будут отправлены по отдельности: {e}")
+        return False
 
 
 async def send_order_to_printer(message: Message, state: FSMContext, payment_info: str):
@@ -399,86 +677,100 @@ async def send_order_to_printer(message: Message, state: FSMContext, payment_inf
     document_list = data.get("documents", [])
     printer_id = data.get("printer_id")
     total_pages = data.get("total_pages", 0)
-    total_price = data.get("total_price", 0)
-    requirements = data.get("requirements", "Без дополнительных требований.")
+    total_price = money(data.get("total_price"))
+    requirements = data.get("requirements")
+    pages_per_sheet, duplex = print_options(data)
+
+    # Повторное нажатие кнопки оплаты после отправки заказа: черновик уже очищен
+    if not document_list:
+        await message.answer("❌ В заказе нет файлов. Отправьте документы для печати.")
+        return
 
     user = message.from_user
-    order_id = f"{user.id}_{int(time.time())}"
+    order_id = await create_order(
+        user.id, printer_id, total_pages, total_price, requirements, payment_info, document_list,
+        pages_per_sheet, duplex
+    )
+
+    if order_id is None:
+        await message.answer("❌ Не удалось оформить заказ. Попробуйте еще раз.")
+        return
 
     # 📌 Формируем описание заказа
-    file_descriptions = "\n".join([
-        f"📄 {doc['file_name']} - {doc['pages']} стр. ({'Ч/Б' if doc['print_type'] == 'bw' else 'Цвет'})"
-        for doc in document_list
-    ])
+    # Сообщение ограничено 4096 символами; подпись с форматом есть у каждого отправленного файла
+    file_descriptions = "\n".join([_file_caption(doc) for doc in document_list[:OPTIONS_FILES_SHOWN]])
+    if len(document_list) > OPTIONS_FILES_SHOWN:
+        file_descriptions += f"\n… и еще файлов: {len(document_list) - OPTIONS_FILES_SHOWN} (всего {len(document_list)})"
 
     caption = (
-        f"📄 Новый заказ от @{user.username or user.full_name}\n"
+        f"📄 Новый заказ №{order_id} от @{user.username or user.full_name}\n"
         f"📂 Файлы: \n{file_descriptions}\n"
-        f"📑 Всего страниц: {total_pages}\n"
+        f"{_options_summary(data)}"
         f"💰 Итоговая стоимость: {total_price} руб.\n"
-        f"📌 Требования: {requirements}\n"
+        f"📌 Комментарий: {requirements or 'нет'}\n"
         f"{payment_info}"
     )
 
     complete_button = InlineKeyboardMarkup(
         inline_keyboard=[
-            [InlineKeyboardButton(text="✅ Выполнено", callback_data=f"complete_{user.id}")],
+            [InlineKeyboardButton(text="✅ Выполнено", callback_data=f"complete_{order_id}")],
             [InlineKeyboardButton(text="❌ Отказаться от выполнения", callback_data=f"reject_order_{order_id}")]
         ]
     )
 
     try:
         # ✅ Отправляем сообщение-заголовок с описанием заказа
-        await message.bot.send_message(chat_id=printer_id, text=caption, reply_markup=complete_button)
+        await scheduler.call(printer_id, message.bot.send_message, chat_id=printer_id, text=caption, reply_markup=complete_button)
 
-        # ✅ Разбиваем файлы на группы по 10
-        batch_size = 10
-        for i in range(0, len(document_list), batch_size):
-            batch = document_list[i:i + batch_size]
-
-            media_group = [
-                {
-                    "type": "document",
-                    "media": doc["file_id"],
-                    "caption": f"{doc['file_name']} ({'Ч/Б' if doc['print_type'] == 'bw' else 'Цвет'})"
-                }
-                for doc in batch
-            ]
+        bundled = (
+            data.get("bundle") and can_bundle(document_list)
+            and await _send_bundle(message.bot, printer_id, order_id, document_list, pages_per_sheet, duplex)
+        )
+        if not bundled:
+            await _send_files(message.bot, printer_id, document_list, pages_per_sheet)
 
-            await message.bot.send_media_group(chat_id=printer_id, media=media_group)
+        await mark_order_sent(order_id)
 
-        await message.answer(f"✅ Ваш заказ отправлен исполнителю!\n💰 Итоговая стоимость: {total_price} руб.")
+        # Заказ сохранен в БД — очищаем черновик, оставляя выбранного исполнителя;
+        # снимок цен сбрасываем, чтобы следующий заказ шел по актуальным ценам
+        await state.set_state(None)
+        await state.update_data(requirements=None, printer_snapshot=None, **empty_totals())
+        await message.answer(f"✅ Ваш заказ №{order_id} отправлен исполнителю!\n💰 Итоговая стоимость: {total_price} руб.")
 
     except TelegramBadRequest as e:
         logger.error(f"Ошибка при отправке файлов: {e}")
         await message.answer("❌ Ошибка при отправке файлов исполнителю.")
 
 @router.callback_query(F.data.startswith("reject_order_"))
-async def reject_order(call: CallbackQuery, state:FSMContext, bot: Bot):
-    order_id = call.data.split("_")[2]  # Получаем ID заказа
-    user_id = int(order_id.split("_")[0])  # Получаем ID заказчика
+async def reject_order(call: CallbackQuery, bot: Bot):
+    order_id = int(call.data.split("_")[2])  # Получаем ID заказа
 
     try:
-        await state.clear()
-        await bot.send_message(user_id, "❌ Исполнитель отказался от выполнения вашего заказа.")
+        order = await reject_order_by_printer(order_id, call.message.chat.id)
+        if not order:
+            await call.answer("Заказ уже обработан.")
+            return
+
+        await bot.send_message(order["user_id"], "❌ Исполнитель отказался от выполнения вашего заказа.")
         await call.message.edit_text("❌ Вы отказались от выполнения заказа.")
 
     except Exception as e:
         logger.error(f"Ошибка при уведомлении пользователя: {e}")
 
 @router.callback_query(F.data.startswith("complete_"))
-async def complete_task(call: CallbackQuery, state: FSMContext):
+async def complete_task(call: CallbackQuery):
     try:
-        user_id = int(call.data.split("_")[1])
+        order_id = int(call.data.split("_")[1])
         printer_id = call.message.chat.id
-        room_number = await get_printer_room(printer_id) or "не указана. Обратитесь к исполнителю в ЛС"
 
-        data = await state.get_data()
-        total_pages = data.get("total_pages", 0)
-        total_price = data.get("total_price", 0)
+        # Статус заказа и статистика исполнителя обновляются одной транзакцией
+        order = await complete_order(order_id, printer_id)
+        if not order:
+            await call.answer("Заказ уже обработан.")
+            return
 
-        await update_printer_stats(printer_id, total_pages, total_price)
-        await state.clear()
+        user_id = order["user_id"]
+        room_number = await get_printer_room(printer_id) or "не указана. Обратитесь к исполнителю в ЛС"
 
         await call.message.bot.send_message(
             chat_id=user_id,
@@ -8,7 +8,7 @@ async def help_command(message: Message):
         "🆘 Помощь\n\n"
         "Я бот для печати документов прямо из Telegram. 📄\n"
         "Вот что я умею:\n"
-        "✅ Принимать файлы в формате PDF(в дальнейшем возможно расширение)\n"
+        "✅ Принимать файлы PDF, изображения JPEG/PNG и документы Word, Excel, PowerPoint и OpenDocument\n"
         "✅ Настраивать параметры печати (цвет/ч/б)\n"
         "✅ Отправлять документы на печать быстро и удобно\n\n"
         "🔹 Чтобы начать, просто выбери того,у кого хочешь напечатать и отправь файл.\n"
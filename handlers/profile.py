@@ -1,13 +1,16 @@
 import logging
+import time
 from aiogram import Router, F
 from aiogram.filters import Command
 from aiogram.types import Message, CallbackQuery
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
-from database.database import (get_printer_info, update_printer_info, update_printer_description, update_printer_type, get_average_rating,
-                               update_printer_price_per_page_color, get_reviews, get_printer_stats)
+from database.database import (get_printer_profile, update_printer_info, update_printer_description, update_printer_type, format_rating,
+                               update_printer_price_per_page_color, get_reviews_page,
+                               encode_review_cursor, decode_review_cursor)
 from keyboards.inline import printer_type
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from services.metrics import histogram
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -15,6 +18,8 @@ logger = logging.getLogger(__name__)
 
 profile_router = Router()
 
+profile_latency = histogram("profile_command_seconds")
+
 
 class EditProfileState(StatesGroup):
     changing_room = State()
@@ -29,22 +34,14 @@ async def take_profile(message: Message):
     await message.delete()
     printer_id = message.from_user.id
 
+    started = time.perf_counter()
     try:
-        info = await get_printer_info(printer_id)
-        printer_stats = await get_printer_stats(printer_id)
+        info = await get_printer_profile(printer_id)
         if not info:
             await message.answer("❌ Вы не зарегистрированы как исполнитель!")
             return
 
-        if not printer_stats:
-            printer_stats = {
-                "total_pages_printed": 0,
-                "total_earnings": 0,
-                "total_orders_completed": 0,
-                "avg_rating": "Нет данных"
-            }
-
-        avg_rating = await get_average_rating(printer_id)
+        avg_rating = format_rating(info["rating_sum"], info["rating_count"])
 
         change_printer_info = InlineKeyboardMarkup(
             inline_keyboard=[
@@ -69,14 +66,16 @@ async def take_profile(message: Message):
             f"🖨 Тип принтера: {info['printer_type'] or 'Не указан'}\n"
             f"⭐ Средний рейтинг: {avg_rating}\n"
             f"📊 Статистика\n"
-            f"📑 Всего страниц напечатано: {printer_stats['total_pages_printed'] or '0'}\n"
-            f"💰 Заработано: {printer_stats['total_earnings'] or '0'}\n"
-            f"📦 Всего заказов выполнено: {printer_stats['total_orders_completed'] or '0'}\n",
+            f"📑 Всего страниц напечатано: {info['total_pages_printed'] or '0'}\n"
+            f"💰 Заработано: {info['total_earnings'] or '0'}\n"
+            f"📦 Всего заказов выполнено: {info['total_orders_completed'] or '0'}\n",
             reply_markup=change_printer_info
         )
     except Exception as e:
         logger.exception(f"Ошибка при получении профиля: {e}")
         await message.answer("❌ Ошибка при загрузке профиля.")
+    finally:
+        profile_latency.observe(time.perf_counter() - started)
 
 
 @profile_router.callback_query(F.data.startswith("my_reviews_"))
@@ -88,19 +87,29 @@ async def view_my_reviews(call: CallbackQuery):
         return
 
     printer_id = int(parts[2])
-    page = int(parts[3]) if len(parts) > 3 else 0
+    reviews_per_page = 3
 
-    reviews = await get_reviews(printer_id)
-    total_reviews = len(reviews)
+    # Формат: my_reviews_<printer_id>_<n|p>_<created_at>_<id>; без курсора — первая страница
+    cursor = decode_review_cursor(parts[4], parts[5]) if len(parts) >= 6 else (None, None)
+    backwards = len(parts) >= 6 and parts[3] == "p"
 
-    if total_reviews == 0:
-        await call.answer("❌ У вас пока нет отзывов.", show_alert=True)
+    reviews = await get_reviews_page(printer_id, *cursor, limit=reviews_per_page + 1, backwards=backwards)
+
+    if not reviews:
+        if cursor[0] is None:
+            await call.answer("❌ У вас пока нет отзывов.", show_alert=True)
+        else:
+            await call.answer("Больше отзывов нет.")
         return
 
-    reviews_per_page = 3
-    start_index = page * reviews_per_page
-    end_index = start_index + reviews_per_page
-    reviews_on_page = reviews[start_index:end_index]
+    # Лишний отзыв показывает, есть ли еще страница в направлении запроса
+    has_more = len(reviews) > reviews_per_page
+    if backwards:
+        reviews_on_page = reviews[-reviews_per_page:]
+        has_prev, has_next = has_more, True
+    else:
+        reviews_on_page = reviews[:reviews_per_page]
+        has_prev, has_next = cursor[0] is not None, has_more
 
     review_texts = []
     for review in reviews_on_page:
@@ -111,10 +120,18 @@ async def view_my_reviews(call: CallbackQuery):
     reviews_text = "\n\n".join(review_texts)
 
     buttons = []
-    if start_index > 0:
-        buttons.append(InlineKeyboardButton(text="◀ Назад", callback_data=f"my_reviews_{printer_id}_{page - 1}"))
-    if end_index < total_reviews:
-        buttons.append(InlineKeyboardButton(text="Вперед ▶", callback_data=f"my_reviews_{printer_id}_{page + 1}"))
+    if has_prev:
+        first = reviews_on_page[0]
+        buttons.append(InlineKeyboardButton(
+            text="◀ Назад",
+            callback_data=f"my_reviews_{printer_id}_p_{encode_review_cursor(first['created_at'], first['id'])}"
+        ))
+    if has_next:
+        last = reviews_on_page[-1]
+        buttons.append(InlineKeyboardButton(
+            text="Вперед ▶",
+            callback_data=f"my_reviews_{printer_id}_n_{encode_review_cursor(last['created_at'], last['id'])}"
+        ))
 
     buttons.append(InlineKeyboardButton(text="❌ Закрыть", callback_data="close_reviews"))
 
@@ -9,7 +9,7 @@ async def support_command(message: Message):
         "Если у вас возникли вопросы, проблемы или что-то не работает, я всегда готов помочь! 🤖\n\n"
         "🔹 Частые вопросы:\n"
         "1. Бот не отвечает: Попробуйте перезапустить бота командой /start.\n"
-        "2. Файл не отправляется: Убедитесь, что файл поддерживается(PDF).\n"
+        "2. Файл не отправляется: Убедитесь, что файл поддерживается (PDF, JPEG/PNG, Word, Excel, PowerPoint, OpenDocument).\n"
         "🔹 Связь с поддержкой:\n"
         "Если вы не нашли решение вашей проблемы,"
         "свяжитесь с нашим менеджером воспользовавшись командой: /print_support.\n\n"
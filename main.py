@@ -1,17 +1,55 @@
 import asyncio
 import logging
+from aiohttp import web
+from aiogram import Bot
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from bot import dp, bot
+from config import (
+    BOT_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_MAX_CONCURRENCY,
+    WEBAPP_HOST, WEBAPP_PORT, SHUTDOWN_TIMEOUT
+)
+from middlewares.concurrency import ConcurrencyLimitMiddleware
+from middlewares.serialization import UserSerializationMiddleware
 from handlers.menu import set_bot_commands
 from handlers import start, help, document, support, print_support, status
 from handlers.callback import router
-from database.database import create_tables
+from database.database import create_tables, init_pool, close_pool
 from handlers.profile import profile_router
 from handlers.print_support import support_router
+from services.pdf_engine import start_pdf_engine, stop_pdf_engine
+from services.metrics import register_source, start_metrics_log, stop_metrics_log, metrics_json
+from services.locks import user_locks
+from services.selection_store import selection_stats
+from services.printer_cache import printer_info_stats
+from services.document_cache import cache_stats
+from services.blob_store import blob_store, start_blob_store, stop_blob_store
 
-async def main():
-    logging.basicConfig(level=logging.INFO)
-    await create_tables()
-    dp.startup.register(set_bot_commands)
+def register_metrics():
+    """Счетчики компонентов для лога метрик и /metrics"""
+    register_source("user_locks", user_locks.stats)
+    register_source("selections", selection_stats)
+    register_source("printer_info", printer_info_stats)
+    register_source("document_cache", cache_stats)
+    register_source("blob_store", blob_store.stats)
+
+def setup_dispatcher(bootstrap: bool = True):
+    """Регистрация хуков и роутеров; bootstrap=False — без миграций и команд (для воркеров)"""
+    dp.startup.register(init_pool)
+    if bootstrap:
+        dp.startup.register(create_tables)
+    dp.startup.register(start_pdf_engine)
+    dp.startup.register(start_metrics_log)
+    dp.startup.register(start_blob_store)
+    if bootstrap:
+        dp.startup.register(set_bot_commands)
+    dp.shutdown.register(close_pool)
+    dp.shutdown.register(stop_pdf_engine)
+    dp.shutdown.register(stop_metrics_log)
+    dp.shutdown.register(stop_blob_store)
+    register_metrics()
+
+    # Апдейты одного пользователя обрабатываются по очереди, разных — параллельно
+    dp.update.outer_middleware(UserSerializationMiddleware())
 
     #роутеры
     dp.include_router(document.router)
@@ -20,8 +58,58 @@ async def main():
     dp.include_router(router)
     dp.include_router(status.router)
 
+async def main():
+    logging.basicConfig(level=logging.INFO)
+    setup_dispatcher()
+
     print(dp.resolve_used_update_types())
+    await bot.delete_webhook()
     await dp.start_polling(bot)
 
+async def on_webhook_startup(bot: Bot):
+    await bot.set_webhook(
+        f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=WEBHOOK_MAX_CONCURRENCY
+    )
+
+def run_webhook():
+    """Запуск в режиме вебхука на aiohttp вместо long polling"""
+    if not WEBHOOK_URL.startswith("https://"):
+        raise SystemExit(
+            "Для BOT_MODE=webhook задайте WEBHOOK_URL — публичный адрес бота вида https://example.com "
+            f"(сейчас: {WEBHOOK_URL!r})"
+        )
+    logging.basicConfig(level=logging.INFO)
+    setup_dispatcher()
+    dp.startup.register(on_webhook_startup)
+
+    limiter = ConcurrencyLimitMiddleware(WEBHOOK_MAX_CONCURRENCY)
+    dp.update.outer_middleware(limiter)
+
+    app = web.Application()
+
+    async def drain(_: web.Application):
+        # Даем уже принятым апдейтам обработаться до закрытия пула БД и сессии бота
+        await limiter.wait_idle(SHUTDOWN_TIMEOUT)
+
+    app.on_shutdown.append(drain)
+
+    async def metrics(_: web.Request):
+        return web.Response(text=metrics_json(), content_type="application/json")
+
+    app.router.add_get("/metrics", metrics)
+
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    web.run_app(app, host=WEBAPP_HOST, port=WEBAPP_PORT, shutdown_timeout=SHUTDOWN_TIMEOUT)
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    if BOT_MODE == "webhook":
+        run_webhook()
+    elif BOT_MODE == "supervisor":
+        from supervisor import run_supervisor
+        asyncio.run(run_supervisor())
+    else:
+        asyncio.run(main())
@@ -0,0 +1,45 @@
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, User
+
+from services.locks import KeyedLock, user_locks
+
+logger = logging.getLogger(__name__)
+
+USER_MAX_PENDING = int(os.getenv("USER_MAX_PENDING", 50))
+
+
+class UserSerializationMiddleware(BaseMiddleware):
+    """
+    Последовательная обработка апдейтов одного пользователя.
+
+    Разные пользователи обрабатываются параллельно; апдейты одного пользователя ждут друг друга,
+    поэтому чтение-изменение-запись данных FSM (например, список documents) не теряет изменения.
+    Если у пользователя скопилось больше USER_MAX_PENDING апдейтов, новые отбрасываются.
+    """
+
+    def __init__(self, locks: KeyedLock = user_locks, max_pending: int = USER_MAX_PENDING):
+        self.locks = locks
+        self.max_pending = max_pending
+        self.dropped = 0
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user: User = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        if self.locks.depth(user.id) >= self.max_pending:
+            self.dropped += 1
+            logger.warning(f"Слишком много апдейтов от пользователя {user.id}, апдейт пропущен")
+            return None
+
+        async with self.locks.lock(user.id):
+            return await handler(event, data)
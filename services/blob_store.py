@@ -0,0 +1,205 @@
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+# Локальное хранилище файлов: скачанные документы и их PDF-версии.
+# Индекс и лимиты действуют в пределах процесса, поэтому у каждого воркера supervisor свой подкаталог
+# (WORKER_INDEX задает супервизор), а BLOB_MAX_BYTES супервизор делит между воркерами.
+BLOB_DIR = os.getenv("BLOB_DIR") or os.path.join(tempfile.gettempdir(), "printbot-blobs")
+BLOB_MAX_BYTES = int(os.getenv("BLOB_MAX_BYTES", 1024 * 1024 * 1024))
+BLOB_RETENTION = float(os.getenv("BLOB_RETENTION", 3 * 24 * 3600))
+BLOB_EVICT_INTERVAL = float(os.getenv("BLOB_EVICT_INTERVAL", 600))
+# Незавершенная запись старше этого возраста считается брошенной
+BLOB_PART_MAX_AGE = float(os.getenv("BLOB_PART_MAX_AGE", 3600))
+
+_worker_index = os.getenv("WORKER_INDEX")
+BLOB_ROOT = os.path.join(BLOB_DIR, f"worker-{_worker_index}" if _worker_index is not None else "main")
+
+
+class BlobStore:
+    """
+    Файлы на диске по ключу (file_unique_id Telegram или производному от него).
+
+    Имя файла — sha256 ключа. Общий объем ограничен max_bytes: при переполнении удаляются давно
+    не использованные файлы; файлы старше retention секунд с последнего обращения удаляются всегда.
+    Файл, который сейчас читается, не удаляется. Одновременные запросы одного ключа
+    скачивают его один раз. Ограничения действуют в пределах процесса: каталог root не должен
+    использоваться несколькими процессами одновременно.
+    """
+
+    def __init__(self, root: str, max_bytes: int, retention: float, part_max_age: float = BLOB_PART_MAX_AGE):
+        self.root = root
+        self.part_max_age = part_max_age
+        self.max_bytes = max_bytes
+        self.retention = retention
+        self._entries = OrderedDict()  # ключ (имя файла) -> [размер, время последнего обращения], от давних к свежим
+        self._size = 0
+        self._pins = {}
+        self._loading = {}
+        self._loaded = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _name(self, key: str) -> str:
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.root, name[:2], name)
+
+    def _scan(self):
+        """Восстановление индекса по содержимому каталога (выполняется в потоке)"""
+        entries = []
+        os.makedirs(self.root, exist_ok=True)
+        part_deadline = time.time() - self.part_max_age
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if name.endswith(".part"):
+                    # Свежую запись, возможно, еще ведет другой процесс; удаляем только брошенные
+                    if stat.st_mtime < part_deadline:
+                        os.unlink(path)
+                    continue
+                entries.append((stat.st_mtime, name, stat.st_size))
+        return sorted(entries)
+
+    async def _load(self):
+        for accessed, name, size in await asyncio.to_thread(self._scan):
+            self._entries[name] = [size, accessed]
+            self._size += size
+        self._evict()
+        logger.info(f"Хранилище файлов {self.root}: {len(self._entries)} файлов, {self._size} байт")
+
+    async def _ensure_loaded(self):
+        if self._loaded is None:
+            self._loaded = asyncio.ensure_future(self._load())
+        await self._loaded
+
+    def _unlink(self, name: str):
+        size, _ = self._entries.pop(name)
+        self._size -= size
+        try:
+            os.unlink(self._path(name))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        """Удаление устаревших файлов и давно не использованных сверх лимита объема"""
+        deadline = time.time() - self.retention
+        for name, (size, accessed) in list(self._entries.items()):
+            if self._size <= self.max_bytes and accessed >= deadline:
+                break
+            if name in self._pins:
+                continue
+            self._unlink(name)
+            self.evictions += 1
+
+    def _touch(self, name: str):
+        entry = self._entries[name]
+        entry[1] = time.time()
+        self._entries.move_to_end(name)
+        try:
+            # Время обращения сохраняется в mtime, чтобы порядок вытеснения пережил перезапуск
+            os.utime(self._path(name))
+        except FileNotFoundError:
+            # Файл удален снаружи (например, другим процессом) — скачаем заново
+            self._entries.pop(name)
+            self._size -= entry[0]
+            return False
+        return True
+
+    async def _fetch(self, name: str, fetch):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part = f"{path}.{os.getpid()}.part"
+        try:
+            await fetch(part)
+            os.replace(part, path)
+        except BaseException:
+            if os.path.exists(part):
+                os.unlink(part)
+            raise
+
+        size = os.path.getsize(path)
+        self._entries[name] = [size, time.time()]
+        self._size += size
+
+    @asynccontextmanager
+    async def open(self, key: str, fetch):
+        """
+        Путь к файлу по ключу; если файла нет, он создается вызовом await fetch(path).
+
+        Пока контекст открыт, файл не будет вытеснен.
+        """
+        await self._ensure_loaded()
+        name = self._name(key)
+        self._pins[name] = self._pins.get(name, 0) + 1
+        try:
+            if name in self._entries and self._touch(name):
+                self.hits += 1
+            else:
+                loading = self._loading.get(name)
+                if loading is None:
+                    self.misses += 1
+                    loading = self._loading[name] = asyncio.ensure_future(self._fetch(name, fetch))
+                    loading.add_done_callback(lambda _: self._loading.pop(name, None))
+                await asyncio.shield(loading)
+            yield self._path(name)
+        finally:
+            self._pins[name] -= 1
+            if not self._pins[name]:
+                del self._pins[name]
+            self._evict()
+
+    async def evict_expired(self):
+        """Удаление устаревших файлов без ожидания следующего обращения к хранилищу"""
+        await self._ensure_loaded()
+        self._evict()
+
+    def stats(self):
+        return {
+            "files": len(self._entries),
+            "bytes": self._size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+blob_store = BlobStore(BLOB_ROOT, BLOB_MAX_BYTES, BLOB_RETENTION)
+_evict_task = None
+
+
+async def _evict_loop():
+    while True:
+        await asyncio.sleep(BLOB_EVICT_INTERVAL)
+        try:
+            await blob_store.evict_expired()
+        except Exception as e:
+            logger.error(f"Ошибка при очистке хранилища файлов: {e}")
+
+
+async def start_blob_store():
+    """Периодическая очистка хранилища: срок хранения соблюдается и без новых обращений"""
+    global _evict_task
+    if _evict_task is None:
+        _evict_task = asyncio.create_task(_evict_loop())
+
+
+async def stop_blob_store():
+    global _evict_task
+    if _evict_task is None:
+        return
+    _evict_task.cancel()
+    _evict_task = None
@@ -0,0 +1,39 @@
+import os
+
+from database.database import get_document_info, save_document_info
+from services.cache import TTLCache
+
+DOCUMENT_CACHE_SIZE = int(os.getenv("DOCUMENT_CACHE_SIZE", 4096))
+
+_cache = TTLCache(maxsize=DOCUMENT_CACHE_SIZE)
+
+
+async def get_document(file_unique_id: str):
+    """Данные о документе: сначала из памяти процесса, затем из таблицы document_cache"""
+    info = _cache.get(file_unique_id)
+    if info is not None:
+        return info
+
+    row = await get_document_info(file_unique_id)
+    if not row:
+        return None
+
+    info = {
+        "pages": row["pages"],
+        "color_pages": list(row["color_pages"]) if row["color_pages"] is not None else None,
+        "file_size": row["file_size"],
+    }
+    _cache.set(file_unique_id, info)
+    return info
+
+
+async def put_document(file_unique_id: str, pages: int, color_pages: list = None, file_size: int = None):
+    """Сохранение данных о документе в оба уровня кэша"""
+    info = {"pages": pages, "color_pages": color_pages, "file_size": file_size}
+    _cache.set(file_unique_id, info)
+    await save_document_info(file_unique_id, pages, color_pages, file_size)
+    return info
+
+
+def cache_stats():
+    return _cache.stats()
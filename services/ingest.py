@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import os
+import shutil
+import signal
+import tempfile
+from contextlib import asynccontextmanager
+
+import fitz
+from aiogram import Bot
+
+from services.blob_store import blob_store
+from services.pdf_engine import (
+    PDF_MAX_FILE_SIZE, PDF_TMP_DIR, PdfTooLargeError, PdfEngineBusyError,
+    pdf_slot, analyze_path, download_to, run_in_pool
+)
+
+logger = logging.getLogger(__name__)
+
+# Приведение изображений и офисных документов к PDF
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png"}
+OFFICE_EXTENSIONS = {".doc", ".docx", ".odt", ".rtf", ".xls", ".xlsx", ".ods", ".ppt", ".pptx", ".odp"}
+IMAGE_MIME_TYPES = {"image/jpeg": ".jpg", "image/png": ".png"}
+
+SOFFICE_BIN = os.getenv("SOFFICE_BIN", "soffice")
+CONVERT_TIMEOUT = float(os.getenv("CONVERT_TIMEOUT", 60))
+CONVERT_MAX_PARALLEL = int(os.getenv("CONVERT_MAX_PARALLEL", 2))
+CONVERT_QUEUE_TIMEOUT = float(os.getenv("CONVERT_QUEUE_TIMEOUT", 30))
+
+# Каждый процесс LibreOffice занимает сотни мегабайт, поэтому их число ограничено отдельно от пула PDF
+_converters = asyncio.Semaphore(CONVERT_MAX_PARALLEL)
+
+
+class UnsupportedDocumentError(Exception):
+    """Формат файла не поддерживается"""
+
+
+class DocumentConversionError(Exception):
+    """Не удалось привести файл к PDF"""
+
+
+def document_kind(file_name: str, mime_type: str = None):
+    """Тип файла по расширению (или MIME-типу для изображений): pdf, image, office или None"""
+    extension = os.path.splitext(file_name or "")[1].lower()
+    if extension == ".pdf" or mime_type == "application/pdf":
+        return "pdf"
+    if extension in IMAGE_EXTENSIONS or mime_type in IMAGE_MIME_TYPES:
+        return "image"
+    if extension in OFFICE_EXTENSIONS:
+        return "office"
+    return None
+
+
+def _source_suffix(file_name: str, mime_type: str = None):
+    extension = os.path.splitext(file_name or "")[1].lower()
+    return extension or IMAGE_MIME_TYPES.get(mime_type, ".pdf")
+
+
+def _image_to_pdf(source: str, target: str, filetype: str):
+    """Изображение в одностраничный PDF (выполняется в рабочем процессе)"""
+    with fitz.open(source, filetype=filetype) as image:
+        data = image.convert_to_pdf()
+    with open(target, "wb") as f:
+        f.write(data)
+
+
+async def _office_to_pdf(source: str, out_dir: str) -> str:
+    """Конвертация офисного документа через LibreOffice в отдельном процессе с ограничением по времени"""
+    try:
+        await asyncio.wait_for(_converters.acquire(), CONVERT_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise PdfEngineBusyError("Очередь конвертации документов переполнена")
+
+    try:
+        # Отдельный профиль, иначе параллельные запуски LibreOffice мешают друг другу
+        process = await asyncio.create_subprocess_exec(
+            SOFFICE_BIN, f"-env:UserInstallation=file://{out_dir}/profile",
+            "--headless", "--convert-to", "pdf", "--outdir", out_dir, source,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+            # soffice — лишь запускающий скрипт, конвертирует дочерний soffice.bin: завершаем всю группу процессов
+            start_new_session=True
+        )
+        try:
+            _, stderr = await asyncio.wait_for(process.communicate(), CONVERT_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise DocumentConversionError("Превышено время конвертации")
+        finally:
+            # И при таймауте, и при отмене, и после обычного завершения не оставляем процессов группы
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            if process.returncode is None:
+                await process.wait()
+    except FileNotFoundError:
+        raise DocumentConversionError(f"Конвертер {SOFFICE_BIN} не найден")
+    finally:
+        _converters.release()
+
+    target = os.path.join(out_dir, os.path.splitext(os.path.basename(source))[0] + ".pdf")
+    if process.returncode != 0 or not os.path.exists(target):
+        raise DocumentConversionError(f"Код завершения {process.returncode}: {stderr.decode(errors='ignore').strip()}")
+    return target
+
+
+async def _convert(source: str, kind: str, suffix: str, target: str):
+    """Приведение скачанного файла к PDF и запись результата в target"""
+    if kind == "image":
+        await run_in_pool(_image_to_pdf, source, target, suffix.lstrip("."))
+        return
+
+    work_dir = tempfile.mkdtemp(dir=PDF_TMP_DIR)
+    try:
+        # LibreOffice определяет формат по расширению, а файлы хранилища хранятся без него
+        document = os.path.join(work_dir, "document" + suffix)
+        os.symlink(source, document)
+        shutil.move(await _office_to_pdf(document, work_dir), target)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+@asynccontextmanager
+async def fetch_pdf(bot: Bot, file_id: str, file_name: str, mime_type: str = None, file_unique_id: str = None):
+    """
+    Путь к PDF-версии файла в локальном хранилище.
+
+    Исходный файл скачивается, а его PDF-версия строится только при первом обращении; ключ хранилища —
+    file_unique_id (для черновиков, сохраненных до его появления, — file_id).
+    """
+    kind = document_kind(file_name, mime_type)
+    if kind is None:
+        raise UnsupportedDocumentError(file_name)
+
+    key = file_unique_id or file_id
+
+    async def download(path: str):
+        await download_to(bot, file_id, path)
+
+    if kind == "pdf":
+        async with blob_store.open(key, download) as path:
+            yield path
+        return
+
+    async def convert(path: str):
+        async with blob_store.open(key, download) as source:
+            await _convert(source, kind, _source_suffix(file_name, mime_type), path)
+
+    async with blob_store.open(f"{key}:pdf", convert) as path:
+        yield path
+
+
+async def analyze_document_file(
+    bot: Bot, file_id: str, file_name: str, mime_type: str = None, file_size: int = None, file_unique_id: str = None
+):
+    """Подсчет страниц и поиск цветных страниц файла любого поддерживаемого формата"""
+    if document_kind(file_name, mime_type) is None:
+        raise UnsupportedDocumentError(file_name)
+    if file_size and file_size > PDF_MAX_FILE_SIZE:
+        raise PdfTooLargeError(f"Размер файла {file_size} превышает {PDF_MAX_FILE_SIZE}")
+
+    async with pdf_slot():
+        async with fetch_pdf(bot, file_id, file_name, mime_type, file_unique_id) as path:
+            return await analyze_path(path)
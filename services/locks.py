@@ -0,0 +1,58 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+from services.metrics import histogram
+
+
+class KeyedLock:
+    """
+    Набор блокировок по ключу (например, id пользователя).
+
+    Запись о ключе живет, только пока блокировку кто-то держит или ждет,
+    поэтому память растет с числом активных пользователей, а не всех когда-либо писавших.
+    """
+
+    def __init__(self, name: str):
+        self._locks = {}
+        self.wait_time = histogram(f"{name}_wait_seconds")
+        self.contended = 0
+        self.max_depth = 0
+
+    def depth(self, key) -> int:
+        """Сколько задач держат или ждут блокировку ключа"""
+        entry = self._locks.get(key)
+        return entry[1] if entry else 0
+
+    @asynccontextmanager
+    async def lock(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        self.max_depth = max(self.max_depth, entry[1])
+        if entry[0].locked():
+            self.contended += 1
+
+        try:
+            with self.wait_time.time():
+                await entry[0].acquire()
+            try:
+                yield
+            finally:
+                entry[0].release()
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    def stats(self):
+        return {
+            "active_keys": len(self._locks),
+            "contended": self.contended,
+            "max_depth": self.max_depth,
+            "wait": self.wait_time.snapshot(),
+        }
+
+
+# Общие блокировки по пользователю: обработка апдейтов и отложенные задачи (например, альбомы)
+user_locks = KeyedLock("user_lock")
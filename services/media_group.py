@@ -0,0 +1,55 @@
+import asyncio
+import logging
+import os
+
+from aiogram.fsm.context import FSMContext
+from aiogram.types import Message
+
+from services.locks import user_locks
+
+logger = logging.getLogger(__name__)
+
+# Сколько ждать следующего файла альбома, прежде чем считать альбом полученным
+ALBUM_WINDOW = float(os.getenv("ALBUM_WINDOW", 1.0))
+
+
+class MediaGroupCollector:
+    """
+    Сбор сообщений одного альбома (media_group_id) в пачку.
+
+    Обработчик вызывается один раз на альбом, после того как ALBUM_WINDOW секунд не приходило
+    новых файлов, и выполняется под блокировкой пользователя, как и обычные апдейты.
+    """
+
+    def __init__(self, handler, window: float = ALBUM_WINDOW):
+        self.handler = handler
+        self.window = window
+        self._groups = {}
+        self._tasks = set()
+
+    def add(self, message: Message, state: FSMContext):
+        key = (message.from_user.id, message.media_group_id)
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = {"messages": [], "state": state, "timer": None}
+
+        group["messages"].append(message)
+        if group["timer"] is not None:
+            group["timer"].cancel()
+        group["timer"] = asyncio.get_running_loop().call_later(self.window, self._flush, key)
+
+    def _flush(self, key):
+        group = self._groups.pop(key, None)
+        if group is None:
+            return
+        task = asyncio.create_task(self._run(key[0], group))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, user_id: int, group: dict):
+        messages = sorted(group["messages"], key=lambda m: m.message_id)
+        try:
+            async with user_locks.lock(user_id):
+                await self.handler(messages, group["state"])
+        except Exception as e:
+            logger.exception(f"Ошибка при обработке альбома: {e}")
@@ -0,0 +1,116 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин по умолчанию, в секундах
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Как часто писать метрики в лог, в секундах (0 — не писать)
+METRICS_LOG_INTERVAL = float(os.getenv("METRICS_LOG_INTERVAL", 300))
+
+_histograms = {}
+_sources = {}
+_log_task = None
+
+
+class Histogram:
+    """Гистограмма длительностей с фиксированными корзинами"""
+
+    def __init__(self, name: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def quantile(self, q: float):
+        """Оценка квантиля по верхней границе корзины"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "buckets": dict(zip(self.buckets + (float("inf"),), self.counts)),
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+        }
+
+
+def histogram(name: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+    """Получение (или создание) гистограммы по имени"""
+    if name not in _histograms:
+        _histograms[name] = Histogram(name, buckets)
+    return _histograms[name]
+
+
+def metrics_snapshot():
+    return {name: h.snapshot() for name, h in _histograms.items()}
+
+
+def register_source(name: str, func):
+    """Регистрация функции, возвращающей счетчики компонента (кэша, блокировок и т.п.)"""
+    _sources[name] = func
+
+
+def collect_metrics():
+    """Гистограммы и счетчики всех зарегистрированных компонентов"""
+    result = {"histograms": metrics_snapshot()}
+    for name, func in _sources.items():
+        try:
+            result[name] = func()
+        except Exception as e:
+            result[name] = {"error": str(e)}
+    return result
+
+
+def metrics_json() -> str:
+    return json.dumps(collect_metrics(), default=str, ensure_ascii=False)
+
+
+async def _log_loop():
+    while True:
+        await asyncio.sleep(METRICS_LOG_INTERVAL)
+        logger.info(f"Метрики: {metrics_json()}")
+
+
+async def start_metrics_log():
+    """Периодическая запись метрик в лог"""
+    global _log_task
+    if METRICS_LOG_INTERVAL > 0 and _log_task is None:
+        _log_task = asyncio.create_task(_log_loop())
+
+
+async def stop_metrics_log():
+    global _log_task
+    if _log_task is None:
+        return
+    _log_task.cancel()
+    _log_task = None
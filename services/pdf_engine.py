@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import fitz
+from aiogram import Bot
+
+try:
+    import numpy as np
+except ImportError:  # без numpy страницы не классифицируются, файл печатается целиком Ч/Б или в цвете
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# Настройки пула обработки PDF
+PDF_EXECUTOR = os.getenv("PDF_EXECUTOR", "process")  # process | thread
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", os.cpu_count() or 2))
+PDF_MAX_PENDING = int(os.getenv("PDF_MAX_PENDING", PDF_WORKERS * 4))
+PDF_QUEUE_TIMEOUT = float(os.getenv("PDF_QUEUE_TIMEOUT", 10))
+PDF_TIMEOUT = float(os.getenv("PDF_TIMEOUT", 30))
+PDF_DOWNLOAD_TIMEOUT = float(os.getenv("PDF_DOWNLOAD_TIMEOUT", 60))
+PDF_MAX_FILE_SIZE = int(os.getenv("PDF_MAX_FILE_SIZE", 20 * 1024 * 1024))
+PDF_TMP_DIR = os.getenv("PDF_TMP_DIR") or None
+
+# Определение цветных страниц по миниатюрам
+PDF_COLOR_DETECTION = os.getenv("PDF_COLOR_DETECTION", "1") == "1"
+PDF_COLOR_DPI = int(os.getenv("PDF_COLOR_DPI", 18))
+PDF_COLOR_MAX_PAGES = int(os.getenv("PDF_COLOR_MAX_PAGES", 500))
+PDF_COLOR_BUDGET = float(os.getenv("PDF_COLOR_BUDGET", 15))  # секунд процессорного времени на файл
+PDF_COLOR_CHROMA = int(os.getenv("PDF_COLOR_CHROMA", 32))  # разброс каналов RGB, с которого пиксель считается цветным
+PDF_COLOR_MIN_RATIO = float(os.getenv("PDF_COLOR_MIN_RATIO", 0.002))  # доля цветных пикселей для цветной страницы
+
+executor = None
+_slots = asyncio.Semaphore(PDF_MAX_PENDING)
+_stuck = set()
+
+
+class PdfTooLargeError(Exception):
+    """Файл превышает допустимый размер"""
+
+
+class PdfEngineBusyError(Exception):
+    """Очередь обработки PDF переполнена"""
+
+
+def _is_color_page(page) -> bool:
+    """Цветная ли страница: по миниатюре считается доля пикселей с заметной разницей каналов RGB"""
+    pixmap = page.get_pixmap(matrix=fitz.Matrix(PDF_COLOR_DPI / 72, PDF_COLOR_DPI / 72), colorspace=fitz.csRGB, alpha=False)
+    pixels = np.frombuffer(pixmap.samples, dtype=np.uint8).reshape(pixmap.height, pixmap.stride)
+    pixels = pixels[:, :pixmap.width * 3].reshape(pixmap.height, pixmap.width, 3)
+    chroma = pixels.max(axis=2) - pixels.min(axis=2)
+    return np.count_nonzero(chroma > PDF_COLOR_CHROMA) > PDF_COLOR_MIN_RATIO * chroma.size
+
+
+def _analyze_pages(path: str):
+    """
+    Подсчет страниц и номера цветных страниц (выполняется в рабочем процессе).
+
+    Номера страниц начинаются с 1. Если анализ недоступен или не уложился в PDF_COLOR_BUDGET,
+    вместо списка возвращается None — тогда файл можно напечатать только целиком Ч/Б или в цвете.
+    """
+    with fitz.open(path, filetype="pdf") as doc:
+        pages = len(doc)
+        if np is None or not PDF_COLOR_DETECTION or pages > PDF_COLOR_MAX_PAGES:
+            return pages, None
+
+        deadline = time.thread_time() + PDF_COLOR_BUDGET
+        color_pages = []
+        for number, page in enumerate(doc, start=1):
+            if time.thread_time() > deadline:
+                logger.warning(f"Анализ цвета прерван на странице {number} из {pages}: превышен лимит времени")
+                return pages, None
+            if _is_color_page(page):
+                color_pages.append(number)
+        return pages, color_pages
+
+
+async def start_pdf_engine():
+    """Запуск пула обработки PDF"""
+    global executor
+    if executor is not None:
+        return
+    if PDF_EXECUTOR == "thread":
+        executor = ThreadPoolExecutor(max_workers=PDF_WORKERS, thread_name_prefix="pdf")
+    else:
+        executor = ProcessPoolExecutor(max_workers=PDF_WORKERS)
+    logger.info(f"Пул обработки PDF запущен: {PDF_EXECUTOR}, воркеров: {PDF_WORKERS}")
+
+
+async def stop_pdf_engine():
+    """Остановка пула обработки PDF"""
+    global executor
+    if executor is None:
+        return
+    executor.shutdown(wait=False, cancel_futures=True)
+    executor = None
+
+
+def _restart_process_pool(reason: str):
+    """
+    Принудительная остановка процессов пула и запуск нового: зависшую задачу иначе не прервать,
+    а сломанный пул (процесс упал или убит по памяти) сам не восстанавливается.
+    """
+    global executor
+    old = executor
+    executor = ProcessPoolExecutor(max_workers=PDF_WORKERS)
+    for process in list((old._processes or {}).values()):
+        process.kill()
+    old.shutdown(wait=False, cancel_futures=True)
+    logger.warning(f"Пул обработки PDF перезапущен: {reason}")
+
+
+async def _hold_slot(future):
+    """Поток прервать нельзя: место в очереди остается занятым, пока зависшая задача не завершится"""
+    async with _slots:
+        try:
+            await future
+        except Exception:
+            pass
+
+
+async def run_in_pool(func, *args, timeout: float = PDF_TIMEOUT):
+    """
+    Выполнение функции в пуле с ограничением по времени.
+
+    По истечении времени задача действительно останавливается: процессы пула убиваются и пул создается заново
+    (задачи, попавшие под перезапуск, выполняются повторно один раз). Сломанный пул (упавший процесс)
+    тоже создается заново. В режиме потоков зависшая задача продолжает занимать место в очереди,
+    пока не завершится.
+    """
+    if executor is None:
+        await start_pdf_engine()
+    loop = asyncio.get_running_loop()
+
+    for attempt in range(2):
+        pool = executor
+        try:
+            future = loop.run_in_executor(pool, func, *args)
+        except BrokenProcessPool:
+            # Пул сломался раньше, а перезапустить его было некому
+            if pool is executor:
+                _restart_process_pool("пул был сломан")
+            if attempt:
+                raise
+            continue
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            if isinstance(pool, ProcessPoolExecutor):
+                # Результат убитой задачи никому не нужен
+                future.add_done_callback(lambda f: f.cancelled() or f.exception())
+                if pool is executor:
+                    _restart_process_pool("превышено время обработки")
+            else:
+                task = asyncio.ensure_future(_hold_slot(future))
+                _stuck.add(task)
+                task.add_done_callback(_stuck.discard)
+            raise
+        except BrokenProcessPool:
+            if pool is executor:
+                # Процесс пула упал (возможно, на этом же файле) — без повтора, чтобы не ронять пул снова
+                _restart_process_pool("процесс пула аварийно завершился")
+                raise
+            # Пул перезапущен из-за чужой задачи — повторяем на новом пуле
+            if attempt:
+                raise
+
+
+async def download_to(bot: Bot, file_id: str, path: str):
+    """Потоковая загрузка файла из Telegram в файл на диске"""
+    file = await bot.get_file(file_id)
+    if file.file_size and file.file_size > PDF_MAX_FILE_SIZE:
+        raise PdfTooLargeError(f"Размер файла {file.file_size} превышает {PDF_MAX_FILE_SIZE}")
+
+    await bot.download_file(file.file_path, destination=path, timeout=int(PDF_DOWNLOAD_TIMEOUT))
+    if os.path.getsize(path) > PDF_MAX_FILE_SIZE:
+        raise PdfTooLargeError(f"Размер файла превышает {PDF_MAX_FILE_SIZE}")
+
+
+@asynccontextmanager
+async def pdf_slot():
+    """Место в очереди обработки: ограничивает число файлов, которые одновременно скачиваются и разбираются"""
+    try:
+        await asyncio.wait_for(_slots.acquire(), PDF_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise PdfEngineBusyError("Очередь обработки PDF переполнена")
+    try:
+        yield
+    finally:
+        _slots.release()
+
+
+async def analyze_path(path: str):
+    """Подсчет страниц и поиск цветных страниц уже скачанного PDF"""
+    return await run_in_pool(_analyze_pages, path)
+
@@ -0,0 +1,184 @@
+from decimal import Decimal, ROUND_HALF_UP
+
+# Цены за страницу хранятся в NUMERIC(5,3), стоимость показываем и сохраняем с точностью до копейки
+PRICE_PRECISION = Decimal("0.001")
+MONEY_PRECISION = Decimal("0.01")
+
+PRINT_TYPE_TITLES = {"bw": "Ч/Б", "color": "Цвет", "mixed": "Ч/Б + цветные страницы"}
+PAGES_PER_SHEET = (1, 2, 4)
+
+
+def to_decimal(value) -> Decimal:
+    """Число из данных FSM или БД (строка, Decimal, int или float из старых черновиков)"""
+    if value is None:
+        return Decimal(0)
+    if isinstance(value, Decimal):
+        return value
+    return Decimal(str(value))
+
+
+def money(value) -> Decimal:
+    return to_decimal(value).quantize(MONEY_PRECISION, rounding=ROUND_HALF_UP)
+
+
+def page_prices(prices: dict):
+    """Цены Ч/Б и цветной страницы из снимка цен исполнителя"""
+    return (
+        to_decimal(prices["price_per_page"]).quantize(PRICE_PRECISION),
+        to_decimal(prices["price_per_page_color"]).quantize(PRICE_PRECISION),
+    )
+
+
+def parse_page_range(text: str, page_count: int) -> list:
+    """
+    Номера страниц из строки вида "1-3, 5": в указанном порядке, без повторов.
+
+    ValueError, если строка не разбирается или страницы нет в файле.
+    """
+    pages = []
+    seen = set()
+    for part in text.replace(" ", "").split(","):
+        if not part:
+            continue
+        start, dash, end = part.partition("-")
+        start = int(start)
+        end = int(end) if dash else start
+        if not 1 <= start <= end <= page_count:
+            raise ValueError(f"Страницы {part} нет в файле")
+        for number in range(start, end + 1):
+            if number not in seen:
+                seen.add(number)
+                pages.append(number)
+
+    if not pages:
+        raise ValueError("Не указано ни одной страницы")
+    return pages
+
+
+def selected_pages(doc: dict):
+    """Страницы файла, которые пойдут в печать"""
+    if doc.get("page_range"):
+        return parse_page_range(doc["page_range"], doc["pages"])
+    return range(1, doc["pages"] + 1)
+
+
+def document_usage(doc: dict, pages_per_sheet: int = 1, duplex: bool = False):
+    """
+    Расход на печать файла: (сторон листа, из них цветных, физических листов).
+
+    На одной стороне помещается pages_per_sheet страниц; сторона цветная, если на ней есть хотя бы одна
+    цветная страница (в режиме mixed — из doc["color_pages"]).
+    """
+    pages = selected_pages(doc)
+    sides = -(-len(pages) // pages_per_sheet)
+    print_type = doc.get("print_type")
+
+    if print_type == "color":
+        color_sides = sides
+    elif print_type == "mixed":
+        color_pages = set(doc.get("color_pages") or ())
+        color_sides = sum(
+            1 for start in range(0, len(pages), pages_per_sheet)
+            if any(number in color_pages for number in pages[start:start + pages_per_sheet])
+        )
+    else:
+        color_sides = 0
+
+    sheets = -(-sides // 2) if duplex else sides
+    return sides, color_sides, sheets
+
+
+def document_cost(doc: dict, prices: dict, pages_per_sheet: int = 1, duplex: bool = False) -> Decimal:
+    """Стоимость файла: каждая напечатанная сторона листа по цене Ч/Б или цветной страницы"""
+    if doc.get("print_type") is None:
+        return Decimal(0)
+
+    bw_price, color_price = page_prices(prices)
+    sides, color_sides, _ = document_usage(doc, pages_per_sheet, duplex)
+    return money(color_sides * color_price + (sides - color_sides) * bw_price)
+
+
+def print_options(data: dict):
+    return data.get("pages_per_sheet", 1), data.get("duplex", False)
+
+
+def _totals(data: dict):
+    return (
+        data.get("total_pages", 0),
+        data.get("total_sheets", data.get("total_pages", 0)),
+        to_decimal(data.get("total_price")),
+    )
+
+
+def add_to_totals(data: dict, new_documents: list) -> dict:
+    """Поля FSM для обновления итогов после добавления файлов (файлы без формата печати пока ничего не стоят)"""
+    pages_per_sheet, duplex = print_options(data)
+    total_pages, total_sheets, total_price = _totals(data)
+
+    for doc in new_documents:
+        doc["sides"], _, doc["sheets"] = document_usage(doc, pages_per_sheet, duplex)
+        total_pages += doc["sides"]
+        total_sheets += doc["sheets"]
+
+    return {"total_pages": total_pages, "total_sheets": total_sheets, "total_price": str(money(total_price))}
+
+
+def reprice(data: dict, indexes, prices: dict, print_type: str = None) -> dict:
+    """
+    Пересчет файлов с номерами indexes (и установка формата печати, если он передан).
+
+    Итоги меняются на разницу по измененным файлам, без пересчета всего заказа.
+    Файлы, для которых цветные страницы не определены, в режиме mixed считаются цветными.
+    Возвращает поля для state.update_data; data["documents"] изменяется на месте.
+    """
+    documents = data.get("documents", [])
+    pages_per_sheet, duplex = print_options(data)
+    total_pages, total_sheets, total_price = _totals(data)
+
+    for index in indexes:
+        doc = documents[index]
+        if print_type is not None:
+            doc["print_type"] = "color" if print_type == "mixed" and doc.get("color_pages") is None else print_type
+
+        old_sides = doc.get("sides", doc["pages"])
+        old_sheets = doc.get("sheets", old_sides)
+        old_cost = to_decimal(doc.get("cost"))
+
+        doc["sides"], _, doc["sheets"] = document_usage(doc, pages_per_sheet, duplex)
+        cost = document_cost(doc, prices, pages_per_sheet, duplex)
+        doc["cost"] = str(cost)
+
+        total_pages += doc["sides"] - old_sides
+        total_sheets += doc["sheets"] - old_sheets
+        total_price += cost - old_cost
+
+    return {
+        "documents": documents,
+        "total_pages": total_pages,
+        "total_sheets": total_sheets,
+        "total_price": str(money(total_price)),
+    }
+
+
+def apply_print_type(data: dict, indexes, print_type: str, prices: dict) -> dict:
+    """Установка формата печати для файлов с номерами indexes"""
+    return reprice(data, indexes, prices, print_type)
+
+
+def set_print_options(data: dict, prices: dict, pages_per_sheet: int = None, duplex: bool = None) -> dict:
+    """Изменение параметров печати всего заказа; пересчитываются все файлы"""
+    if pages_per_sheet is not None:
+        data["pages_per_sheet"] = pages_per_sheet
+    if duplex is not None:
+        data["duplex"] = duplex
+
+    update = reprice(data, range(len(data.get("documents", []))), prices)
+    update.update(pages_per_sheet=data.get("pages_per_sheet", 1), duplex=data.get("duplex", False))
+    return update
+
+
+def empty_totals() -> dict:
+    return {
+        "documents": [], "total_pages": 0, "total_sheets": 0, "total_price": "0.00",
+        "pages_per_sheet": 1, "duplex": False,
+    }
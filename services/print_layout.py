@@ -0,0 +1,158 @@
+import asyncio
+import html
+import logging
+import os
+import tempfile
+from contextlib import AsyncExitStack, asynccontextmanager
+
+import fitz
+from aiogram import Bot
+
+from services.ingest import fetch_pdf
+from services.pdf_engine import PDF_TMP_DIR, PdfTooLargeError, pdf_slot, run_in_pool
+from services.pricing import selected_pages
+
+logger = logging.getLogger(__name__)
+
+# Общий файл заказа
+BUNDLE_MAX_FILES = int(os.getenv("BUNDLE_MAX_FILES", 50))
+BUNDLE_MAX_SIZE = int(os.getenv("BUNDLE_MAX_SIZE", 50 * 1024 * 1024))  # предел загрузки файла ботом
+BUNDLE_DOWNLOADS = int(os.getenv("BUNDLE_DOWNLOADS", 4))
+BUNDLE_TIMEOUT = float(os.getenv("BUNDLE_TIMEOUT", 120))
+
+
+def _cells(width: float, height: float, pages_per_sheet: int):
+    """Области листа под страницы: 2 — рядом на альбомном листе, 4 — сеткой 2×2"""
+    if pages_per_sheet == 2:
+        return [fitz.Rect(0, 0, width / 2, height), fitz.Rect(width / 2, 0, width, height)]
+    return [
+        fitz.Rect(x * width / 2, y * height / 2, (x + 1) * width / 2, (y + 1) * height / 2)
+        for y in range(2) for x in range(2)
+    ]
+
+
+def _runs(pages: list):
+    """Подряд идущие страницы одним диапазоном, чтобы копировать их за один вызов"""
+    start = previous = pages[0]
+    for number in pages[1:]:
+        if number != previous + 1:
+            yield start, previous
+            start = number
+        previous = number
+    yield start, previous
+
+
+def _append_layout(out, src, pages: list, pages_per_sheet: int):
+    """Перенос выбранных страниц в итоговый документ с раскладкой по несколько на лист"""
+    if pages_per_sheet == 1:
+        for start, end in _runs(pages):
+            out.insert_pdf(src, from_page=start - 1, to_page=end - 1)
+        return
+
+    width, height = fitz.paper_size("a4-l" if pages_per_sheet == 2 else "a4")
+    cells = _cells(width, height, pages_per_sheet)
+    for start in range(0, len(pages), pages_per_sheet):
+        sheet = out.new_page(width=width, height=height)
+        for rect, number in zip(cells, pages[start:start + pages_per_sheet]):
+            sheet.show_pdf_page(rect, src, number - 1)
+
+
+def _layout_pdf(source: str, target: str, pages: list, pages_per_sheet: int):
+    """
+    Итоговый PDF для печати: выбранные страницы и раскладка по несколько на лист (выполняется в рабочем процессе).
+
+    Исходный файл читается с диска, страницы переносятся по одной (или подряд идущими диапазонами),
+    поэтому в памяти не держится весь исходный документ.
+    """
+    with fitz.open(source, filetype="pdf") as src, fitz.open() as out:
+        _append_layout(out, src, pages, pages_per_sheet)
+        out.save(target, garbage=3, deflate=True)
+
+
+def _bundle_pdf(target: str, parts: list, duplex: bool):
+    """
+    Один PDF на весь заказ: перед каждым файлом — страница-разделитель с его названием и форматом печати
+    (выполняется в рабочем процессе). Исходные файлы открываются по очереди.
+    """
+    width, height = fitz.paper_size("a4")
+    with fitz.open() as out:
+        for source, title, pages, pages_per_sheet in parts:
+            if duplex and len(out) % 2:
+                # Предыдущий файл закончился на лицевой стороне: разделитель печатается на новом листе
+                out.new_page(width=width, height=height)
+            separator = out.new_page(width=width, height=height)
+            separator.insert_htmlbox(fitz.Rect(72, 72, width - 72, height - 72), f"<h2>{html.escape(title)}</h2>")
+            if duplex:
+                # Файл начинается с нового листа, а не на обороте разделителя
+                out.new_page(width=width, height=height)
+            with fitz.open(source, filetype="pdf") as src:
+                _append_layout(out, src, pages, pages_per_sheet)
+        out.save(target, garbage=3, deflate=True)
+
+
+def can_bundle(documents: list):
+    """
+    Можно ли отправить заказ одним PDF. Общий файл печатается одним заданием, поэтому все файлы должны
+    печататься в одном режиме: все Ч/Б или все в цвете (режим mixed требует разных настроек для страниц).
+    """
+    print_types = {doc.get("print_type") for doc in documents}
+    return 1 < len(documents) <= BUNDLE_MAX_FILES and len(print_types) == 1 and print_types <= {"bw", "color"}
+
+
+def needs_layout(doc: dict, pages_per_sheet: int):
+    """
+    Нужно ли готовить отдельный файл или исполнителю можно переслать исходный.
+
+    Двусторонняя печать на это не влияет: отдельный файл печатается отдельным заданием и всегда начинается
+    с нового листа, а режим duplex исполнитель включает на принтере по параметрам из описания заказа.
+    Выравнивание файлов по листам нужно только в общем файле заказа (_bundle_pdf).
+    """
+    return bool(doc.get("page_range")) or pages_per_sheet != 1
+
+
+@asynccontextmanager
+async def print_file(bot: Bot, doc: dict, pages_per_sheet: int):
+    """Путь к итоговому PDF файла заказа; временный файл удаляется при выходе"""
+    fd, target = tempfile.mkstemp(suffix=".pdf", dir=PDF_TMP_DIR)
+    os.close(fd)
+    try:
+        async with pdf_slot():
+            async with fetch_pdf(bot, doc["file_id"], doc["file_name"], doc.get("mime_type"), doc.get("file_unique_id")) as source:
+                await run_in_pool(_layout_pdf, source, target, list(selected_pages(doc)), pages_per_sheet)
+        yield target
+    finally:
+        os.unlink(target)
+
+
+@asynccontextmanager
+async def bundle_file(bot: Bot, documents: list, titles: list, pages_per_sheet: int, duplex: bool):
+    """Путь к общему PDF заказа; временные файлы удаляются при выходе"""
+    fd, target = tempfile.mkstemp(suffix=".pdf", dir=PDF_TMP_DIR)
+    os.close(fd)
+    downloads = asyncio.Semaphore(BUNDLE_DOWNLOADS)
+
+    async def fetch(sources: AsyncExitStack, doc: dict):
+        async with downloads:
+            return await sources.enter_async_context(
+                fetch_pdf(bot, doc["file_id"], doc["file_name"], doc.get("mime_type"), doc.get("file_unique_id"))
+            )
+
+    try:
+        async with pdf_slot():
+            async with AsyncExitStack() as sources:
+                # Дожидаемся всех загрузок, чтобы при ошибке стек удалил уже скачанные файлы
+                paths = await asyncio.gather(*[fetch(sources, doc) for doc in documents], return_exceptions=True)
+                errors = [path for path in paths if isinstance(path, BaseException)]
+                if errors:
+                    raise errors[0]
+                parts = [
+                    (path, title, list(selected_pages(doc)), pages_per_sheet)
+                    for path, title, doc in zip(paths, titles, documents)
+                ]
+                await run_in_pool(_bundle_pdf, target, parts, duplex, timeout=BUNDLE_TIMEOUT)
+
+        if os.path.getsize(target) > BUNDLE_MAX_SIZE:
+            raise PdfTooLargeError(f"Размер общего файла превышает {BUNDLE_MAX_SIZE}")
+        yield target
+    finally:
+        os.unlink(target)
@@ -0,0 +1,29 @@
+import os
+
+from database.database import get_printer_info, printers_version
+from services.cache import TTLCache
+
+PRINTER_INFO_TTL = float(os.getenv("PRINTER_INFO_TTL", 30))
+PRINTER_INFO_CACHE_SIZE = int(os.getenv("PRINTER_INFO_CACHE_SIZE", 1024))
+
+# Значение — (версия справочника, строка); любое изменение исполнителей в этом процессе сбрасывает кеш,
+# изменения из других процессов становятся видны не позже чем через PRINTER_INFO_TTL
+_info = TTLCache(maxsize=PRINTER_INFO_CACHE_SIZE, ttl=PRINTER_INFO_TTL)
+
+
+async def get_printer_info_cached(printer_id: int):
+    """Информация об исполнителе через кеш с коротким временем жизни"""
+    # Версию берем до запроса, чтобы не сохранить старые данные под новой версией
+    version = printers_version()
+    entry = _info.get(printer_id)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+
+    info = await get_printer_info(printer_id)
+    if info is not None:
+        _info.set(printer_id, (version, info))
+    return info
+
+
+def printer_info_stats():
+    return _info.stats()
@@ -0,0 +1,131 @@
+import asyncio
+import os
+import time
+
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+from database.database import get_all_printers, printers_version
+from services.cache import TTLCache
+
+# Кэш сбрасывается при любой записи в printers в этом процессе;
+# TTL ограничивает устаревание данных, измененных другими воркерами
+PRINTER_DIRECTORY_TTL = float(os.getenv("PRINTER_DIRECTORY_TTL", 30))
+PRINTER_DIRECTORY_PAGES = int(os.getenv("PRINTER_DIRECTORY_PAGES", 512))
+PRINTERS_PER_PAGE = int(os.getenv("PRINTERS_PER_PAGE", 8))
+
+SORT_TITLES = {
+    "price": "💰 Цена",
+    "rating": "⭐ Рейтинг",
+    "room": "🏠 Комната",
+}
+
+_MISSING = object()
+
+
+def required_capabilities(type_filter: str):
+    """Требуемые возможности по фильтру (например, laser_color_scan или all)"""
+    if type_filter == "all":
+        return None, False, False
+    parts = type_filter.replace("printer_type_", "").split("_")
+    return parts[0], "color" in parts, "scan" in parts
+
+
+def page_callback(type_filter: str, sort: str, direction: str = "n", cursor: int = 0):
+    """callback_data страницы списка: pl:<фильтр>:<сортировка>:<n|p>:<id>"""
+    return f"pl:{type_filter}:{sort}:{direction}:{cursor}"
+
+
+class PrinterDirectory:
+    """Кэш страниц списка активных исполнителей с готовыми сообщениями и клавиатурами"""
+
+    def __init__(self, ttl: float = PRINTER_DIRECTORY_TTL, max_pages: int = PRINTER_DIRECTORY_PAGES):
+        self.ttl = ttl
+        self._lock = asyncio.Lock()
+        self._version = None
+        self._loaded_at = 0.0
+        self._pages = TTLCache(maxsize=max_pages)
+
+    def invalidate(self):
+        self._version = None
+
+    def _is_fresh(self):
+        return self._version == printers_version() and time.monotonic() - self._loaded_at < self.ttl
+
+    async def _refresh(self):
+        if self._is_fresh():
+            return
+        async with self._lock:
+            if self._is_fresh():
+                return
+            self._pages = TTLCache(maxsize=self._pages.maxsize)
+            self._version = printers_version()
+            self._loaded_at = time.monotonic()
+
+    @staticmethod
+    def _render(printers, type_filter, sort, has_prev, has_next):
+        text = "\n\n".join([
+            f"👤 {p['full_name']} | 🏠 {p['room_number']} | 💰 {p['price_per_page']} руб.(ч/б) | 💰 {p['price_per_page_color']} руб.(цвет)\n🖨 {p['printer_type']}"
+            for p in printers
+        ])
+
+        rows = [
+            [InlineKeyboardButton(text=f"{p['full_name']}", callback_data=f"printer_{p['chat_id']}")]
+            for p in printers
+        ]
+
+        navigation = []
+        if has_prev:
+            navigation.append(InlineKeyboardButton(
+                text="◀ Назад", callback_data=page_callback(type_filter, sort, "p", printers[0]["id"])
+            ))
+        if has_next:
+            navigation.append(InlineKeyboardButton(
+                text="Вперед ▶", callback_data=page_callback(type_filter, sort, "n", printers[-1]["id"])
+            ))
+        if navigation:
+            rows.append(navigation)
+
+        rows.append([
+            InlineKeyboardButton(text=("• " if key == sort else "") + title, callback_data=page_callback(type_filter, key))
+            for key, title in SORT_TITLES.items()
+        ])
+
+        return f"Выберите исполнителя для печати:\n\n{text}", InlineKeyboardMarkup(inline_keyboard=rows)
+
+    async def page_view(self, type_filter: str = "all", sort: str = "price", direction: str = "n", cursor: int = 0):
+        """Текст и клавиатура страницы списка (None, если исполнителей нет)"""
+        if sort not in SORT_TITLES:
+            sort = "price"
+
+        await self._refresh()
+        pages = self._pages
+        key = (type_filter, sort, direction, cursor)
+        view = pages.get(key, _MISSING)
+        if view is not _MISSING:
+            return view
+
+        technology, color, scan = required_capabilities(type_filter)
+        backwards = direction == "p" and cursor
+        printers = await get_all_printers(
+            sort=sort,
+            after_id=cursor if cursor and not backwards else None,
+            before_id=cursor if backwards else None,
+            limit=PRINTERS_PER_PAGE + 1,
+            technology=technology, color=color, scan=scan
+        )
+
+        # Лишняя запись показывает, есть ли еще страница в направлении запроса
+        has_more = len(printers) > PRINTERS_PER_PAGE
+        if backwards:
+            printers = printers[-PRINTERS_PER_PAGE:]
+            has_prev, has_next = has_more, True
+        else:
+            printers = printers[:PRINTERS_PER_PAGE]
+            has_prev, has_next = bool(cursor), has_more
+
+        view = self._render(printers, type_filter, sort, has_prev, has_next) if printers else None
+        pages.set(key, view)
+        return view
+
+
+printer_directory = PrinterDirectory()
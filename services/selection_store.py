@@ -0,0 +1,72 @@
+import os
+
+from aiogram.fsm.context import FSMContext
+
+from services.cache import TTLCache
+from services.printer_cache import get_printer_info_cached
+
+SELECTION_TTL = float(os.getenv("SELECTION_TTL", 24 * 3600))
+SELECTION_MAX_SIZE = int(os.getenv("SELECTION_MAX_SIZE", 10000))
+
+# Быстрый слой в памяти процесса; источник истины — данные FSM (общие для всех воркеров)
+_selections = TTLCache(maxsize=SELECTION_MAX_SIZE, ttl=SELECTION_TTL)
+
+
+def printer_snapshot(printer_id: int, printer_info):
+    """Цены и реквизиты исполнителя на момент выбора (строки — данные FSM сериализуются в JSON)"""
+    return {
+        "printer_id": printer_id,
+        "price_per_page": str(printer_info["price_per_page"] if printer_info["price_per_page"] is not None else 0.25),
+        "price_per_page_color": str(
+            printer_info["price_per_page_color"] if printer_info["price_per_page_color"] is not None else 0.6
+        ),
+        "card_number": printer_info["card_number"],
+    }
+
+
+async def set_selected_printer(user_id: int, printer_id: int, state: FSMContext):
+    """Запоминание выбранного пользователем исполнителя вместе со снимком его цен"""
+    _selections.set(user_id, printer_id)
+    printer_info = await get_printer_info_cached(printer_id)
+    snapshot = printer_snapshot(printer_id, printer_info) if printer_info else None
+    await state.update_data(selected_printer_id=printer_id, printer_snapshot=snapshot)
+
+
+async def get_selected_printer(user_id: int, state: FSMContext):
+    """Получение выбранного исполнителя (None, если выбор не сделан или устарел)"""
+    printer_id = _selections.get(user_id)
+    if printer_id is not None:
+        return printer_id
+
+    data = await state.get_data()
+    printer_id = data.get("selected_printer_id")
+    if printer_id is not None:
+        _selections.set(user_id, printer_id)
+    return printer_id
+
+
+async def get_printer_snapshot(state: FSMContext, printer_id: int, data: dict = None):
+    """
+    Снимок цен исполнителя из данных FSM.
+
+    Цена фиксируется при выборе исполнителя или первом файле черновика и не меняется до конца заказа;
+    после отправки заказа снимок сбрасывается и создается заново при следующем обращении.
+    """
+    if data is None:
+        data = await state.get_data()
+
+    snapshot = data.get("printer_snapshot")
+    if snapshot and snapshot["printer_id"] == printer_id:
+        return snapshot
+
+    printer_info = await get_printer_info_cached(printer_id)
+    if not printer_info:
+        return None
+
+    snapshot = printer_snapshot(printer_id, printer_info)
+    await state.update_data(printer_snapshot=snapshot)
+    return snapshot
+
+
+def selection_stats():
+    return _selections.stats()
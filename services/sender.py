@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import os
+import random
+import time
+
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError
+
+from services.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: ~30 сообщений в секунду на бота и ~1 в секунду на чат (с небольшими всплесками)
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", 25))
+SEND_GLOBAL_BURST = float(os.getenv("SEND_GLOBAL_BURST", 30))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", 1))
+SEND_CHAT_BURST = float(os.getenv("SEND_CHAT_BURST", 20))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", 5))
+SEND_BACKOFF_BASE = float(os.getenv("SEND_BACKOFF_BASE", 0.5))
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity в запасе"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Остановка отправки (например, по retry_after от Telegram)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, cost: float = 1):
+        cost = min(cost, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= cost:
+                    self.tokens -= cost
+                    return
+                await asyncio.sleep((cost - self.tokens) / self.rate)
+
+
+class MessageScheduler:
+    """Отправка запросов к Telegram с учетом общего и поканального лимитов и повторами при 429"""
+
+    def __init__(
+        self, global_rate: float = SEND_GLOBAL_RATE, global_burst: float = SEND_GLOBAL_BURST,
+        chat_rate: float = SEND_CHAT_RATE, chat_burst: float = SEND_CHAT_BURST, max_retries: int = SEND_MAX_RETRIES
+    ):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        # Ведро чата восстанавливается полностью за chat_burst / chat_rate секунд, дальше его можно забыть
+        self._chat_buckets = TTLCache(maxsize=10000, ttl=max(chat_burst / chat_rate, 60))
+        self.retries = 0
+        self.flood_waits = 0
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+        # Продлеваем жизнь записи при каждом обращении
+        self._chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    async def call(self, chat_id: int, method, *args, cost: float = 1, **kwargs):
+        """Вызов метода бота (send_message, send_media_group, ...) для чата chat_id"""
+        bucket = self._chat_bucket(chat_id)
+        for attempt in range(self.max_retries + 1):
+            await bucket.acquire(cost)
+            await self.global_bucket.acquire(cost)
+            try:
+                return await method(*args, **kwargs)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.flood_waits += 1
+                delay = e.retry_after + random.uniform(0, 1)
+                logger.warning(f"Flood control для чата {chat_id}: ожидание {delay:.1f} с")
+                bucket.pause(delay)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                delay = SEND_BACKOFF_BASE * 2 ** attempt * random.uniform(0.5, 1.5)
+                logger.warning(f"Ошибка отправки в чат {chat_id} ({e}), повтор через {delay:.1f} с")
+                await asyncio.sleep(delay)
+
+
+scheduler = MessageScheduler()
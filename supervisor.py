@@ -0,0 +1,229 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue as queue_errors
+import signal
+import time
+
+from config import WORKERS, WORKER_QUEUE_SIZE, HEALTH_CHECK_INTERVAL, HEARTBEAT_TIMEOUT, SHUTDOWN_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_INTERVAL = 1.0
+
+_ctx = multiprocessing.get_context("spawn")
+
+
+def shard_for(update: dict, workers: int) -> int:
+    """Номер воркера по id пользователя (или чата), чтобы апдейты одного пользователя шли по порядку"""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        user = value.get("from") or value.get("user") or (value.get("message") or {}).get("from")
+        if user and "id" in user:
+            return user["id"] % workers
+        chat = value.get("chat")
+        if chat and "id" in chat:
+            return chat["id"] % workers
+    return update.get("update_id", 0) % workers
+
+
+def worker_main(index: int, queue, heartbeat):
+    """Точка входа процесса-воркера"""
+    logging.basicConfig(level=logging.INFO)
+    # Ctrl+C приходит всей группе процессов; воркеры останавливает супервизор через очередь
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_worker(index, queue, heartbeat))
+
+
+async def _worker(index: int, queue, heartbeat):
+    from main import setup_dispatcher
+    from bot import dp, bot
+
+    # Таблицы и команды бота уже подготовлены супервизором
+    setup_dispatcher(bootstrap=False)
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+
+    loop = asyncio.get_running_loop()
+    tasks = set()
+
+    async def beat():
+        while True:
+            heartbeat.value = time.time()
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    beat_task = asyncio.create_task(beat())
+    logger.info(f"Воркер {index} запущен")
+
+    try:
+        while True:
+            raw = await loop.run_in_executor(None, queue.get)
+            if raw is None:
+                break
+            task = asyncio.create_task(dp.feed_raw_update(bot, raw))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally:
+        if tasks:
+            await asyncio.wait(tasks, timeout=SHUTDOWN_TIMEOUT)
+        beat_task.cancel()
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        await bot.session.close()
+        logger.info(f"Воркер {index} остановлен")
+
+
+class Worker:
+    def __init__(self, index: int):
+        self.index = index
+        self.queue = _ctx.Queue(maxsize=WORKER_QUEUE_SIZE)
+        self.heartbeat = _ctx.Value("d", time.time())
+        self.process = None
+        self.restarts = 0
+
+    def start(self):
+        self.heartbeat.value = time.time()
+        self.process = _ctx.Process(
+            target=worker_main, args=(self.index, self.queue, self.heartbeat),
+            name=f"bot-worker-{self.index}", daemon=False
+        )
+        # Окружение копируется при запуске процесса: по номеру воркер выбирает свой каталог хранилища файлов
+        os.environ["WORKER_INDEX"] = str(self.index)
+        try:
+            self.process.start()
+        finally:
+            del os.environ["WORKER_INDEX"]
+
+    def is_healthy(self):
+        return self.process.is_alive() and time.time() - self.heartbeat.value < HEARTBEAT_TIMEOUT
+
+    def restart(self):
+        if self.process.is_alive():
+            # Завис: процесс мог быть убит посреди чтения очереди, поэтому заводим новую и переносим в нее
+            # то, что удастся забрать из старой. Апдейты, которые воркер уже взял в обработку, теряются.
+            self.process.terminate()
+            self.process.join(5)
+            old, self.queue = self.queue, _ctx.Queue(maxsize=WORKER_QUEUE_SIZE)
+            moved = self._move_pending(old)
+            try:
+                left = old.qsize()
+            except NotImplementedError:
+                left = None
+            if left:
+                logger.error(f"Воркер {self.index}: потеряно апдейтов из очереди зависшего процесса: {left}")
+            logger.warning(
+                f"Воркер {self.index}: перенесено апдейтов в новую очередь: {moved}; "
+                f"апдейты, которые обрабатывал зависший процесс, потеряны"
+            )
+        self.restarts += 1
+        self.start()
+
+    def _move_pending(self, old) -> int:
+        moved = 0
+        while True:
+            try:
+                # С таймаутом: блокировку чтения мог оставить убитый процесс
+                raw = old.get(timeout=0.1)
+            except queue_errors.Empty:
+                return moved
+            self.queue.put_nowait(raw)
+            moved += 1
+
+
+async def _supervise(workers):
+    while True:
+        await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+        for worker in workers:
+            if not worker.is_healthy():
+                logger.warning(f"Воркер {worker.index} не отвечает, перезапуск (уже перезапускался: {worker.restarts})")
+                worker.restart()
+
+
+async def _poll(bot, workers, allowed_updates, position: dict):
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            updates = await bot.get_updates(offset=position["offset"], timeout=25, allowed_updates=allowed_updates)
+        except Exception as e:
+            logger.error(f"Ошибка при получении обновлений: {e}")
+            await asyncio.sleep(1)
+            continue
+
+        for update in updates:
+            raw = update.model_dump(mode="json", by_alias=True, exclude_none=True)
+            worker = workers[shard_for(raw, len(workers))]
+            # Блокирующий put при заполненной очереди притормаживает опрос — это и есть backpressure
+            await loop.run_in_executor(None, worker.queue.put, raw)
+            position["offset"] = update.update_id + 1
+
+
+def _split_budgets():
+    """
+    Делим пул PDF, соединения с БД и объем хранилища файлов между воркерами: иначе каждый воркер берет их столько, сколько
+    рассчитано на весь сервер. Воркеры наследуют окружение супервизора.
+    """
+    from services.pdf_engine import PDF_WORKERS
+    from services.blob_store import BLOB_MAX_BYTES
+    from database.database import DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE
+
+    pdf_workers = max(1, PDF_WORKERS // WORKERS)
+    pool_max = max(1, DB_POOL_MAX_SIZE // WORKERS)
+    os.environ["PDF_WORKERS"] = str(pdf_workers)
+    os.environ["BLOB_MAX_BYTES"] = str(BLOB_MAX_BYTES // WORKERS)
+    os.environ["DB_POOL_MAX_SIZE"] = str(pool_max)
+    os.environ["DB_POOL_MIN_SIZE"] = str(min(DB_POOL_MIN_SIZE, pool_max))
+    logger.info(f"На воркер: процессов PDF {pdf_workers}, соединений с БД до {pool_max}")
+
+
+async def run_supervisor():
+    """Супервизор: получает обновления и распределяет их между WORKERS процессами по id пользователя"""
+    logging.basicConfig(level=logging.INFO)
+
+    from main import setup_dispatcher
+    from bot import dp, bot
+    from database.database import init_pool, close_pool, create_tables
+    from handlers.menu import set_bot_commands
+
+    setup_dispatcher(bootstrap=False)
+    allowed_updates = dp.resolve_used_update_types()
+
+    await init_pool()
+    await create_tables()
+    await close_pool()
+    await set_bot_commands(bot)
+    await bot.delete_webhook()
+
+    _split_budgets()
+    workers = [Worker(i) for i in range(WORKERS)]
+    for worker in workers:
+        worker.start()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    position = {"offset": None}
+    poll_task = asyncio.create_task(_poll(bot, workers, allowed_updates, position))
+    health_task = asyncio.create_task(_supervise(workers))
+
+    await stop.wait()
+    logger.info("Остановка супервизора")
+    health_task.cancel()
+    poll_task.cancel()
+
+    # Подтверждаем уже розданные воркерам обновления, чтобы после перезапуска они не пришли повторно
+    if position["offset"] is not None:
+        try:
+            await bot.get_updates(offset=position["offset"], timeout=0, limit=1)
+        except Exception as e:
+            logger.error(f"Ошибка при подтверждении обновлений: {e}")
+
+    for worker in workers:
+        worker.queue.put(None)
+    for worker in workers:
+        worker.process.join(SHUTDOWN_TIMEOUT)
+        if worker.process.is_alive():
+            worker.process.terminate()
+
+    await bot.session.close()